@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark resizing large animated GIFs: latency, peak memory (how much
+resizing grows the peak RSS) and output size of resizing all frames at
+once (as resize_animated_gif used to) vs. frame by frame within the frame
+and pixel budgets
+
+Usage: python benchmarks/gif.py [--repetitions N]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageSequence
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+from ivatar.utils import resize_animated_gif  # noqa: E402
+
+SIZES = (80, 512)
+ANIMATIONS = ((50, 512), (300, 512), (100, 1024), (1000, 256))
+# Resizing is measured by how much it grows the peak RSS of a process of
+# its own, so that must start out small: spawned rather than forked from
+# this one, with the test GIFs made in another one
+CONTEXT = multiprocessing.get_context("spawn")
+
+
+def animation(frames, size):
+    """
+    Return an animated test GIF: a ball moving over a striped background,
+    with transparent corners
+    """
+    palette = [0, 0, 0] + [(i * 53) % 256 for i in range(765)]
+    images = []
+    for i in range(frames):
+        img = Image.new("P", (size, size), 0)
+        img.putpalette(palette)
+        draw = ImageDraw.Draw(img)
+        for stripe in range(0, size, 16):
+            draw.rectangle((stripe, size // 8, stripe + 7, size), fill=2 + stripe % 50)
+        pos = i * size // frames
+        draw.ellipse((pos, pos, pos + size // 4, pos + size // 4), fill=1 + i % 200)
+        images.append(img)
+    output = BytesIO()
+    images[0].save(
+        output,
+        "GIF",
+        save_all=True,
+        append_images=images[1:],
+        duration=40,
+        loop=0,
+        transparency=0,
+    )
+    return output.getvalue()
+
+
+def all_frames(input_pil, size):
+    """
+    Resize as resize_animated_gif used to, with a copy of every frame
+    """
+    frames = []
+    for frame in ImageSequence.Iterator(input_pil):
+        new_frame = frame.copy()
+        new_frame.thumbnail(size)
+        frames.append(new_frame)
+    output = BytesIO()
+    frames[0].save(
+        output,
+        format="gif",
+        save_all=True,
+        optimize=False,
+        append_images=frames[1:],
+        disposal=input_pil.disposal_method,
+        **input_pil.info,
+    )
+    return output
+
+
+def peak_rss():
+    """
+    Return the peak RSS (MB) of this process
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(resize, data, size, repetitions, results):
+    """
+    Resize (in a process of its own) and put the median ms, growth of the
+    peak RSS (MB) over the one of the interpreter and the data, bytes and
+    frames into results
+    """
+    baseline = peak_rss()
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        output = resize(Image.open(BytesIO(data)), (size, size)).getvalue()
+        times.append((time.perf_counter() - start) * 1000)
+    results.put(
+        (
+            statistics.median(times),
+            peak_rss() - baseline,
+            len(output),
+            Image.open(BytesIO(output)).n_frames,
+        )
+    )
+
+
+def run(resize, data, size, repetitions):
+    """
+    Return the median ms, peak memory (MB), bytes and frames of resizing,
+    in a new process, so the peak memory is its own
+    """
+    results = CONTEXT.Queue()
+    process = CONTEXT.Process(
+        target=measure, args=(resize, data, size, repetitions, results)
+    )
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    """
+    Run the benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--repetitions",
+        type=int,
+        default=3,
+        help="Repetitions per measurement (default: 3)",
+    )
+    repetitions = parser.parse_args().repetitions
+    if repetitions < 1:
+        parser.error("at least 1 repetition is needed")
+    print(
+        "%-20s %8s %8s %7s %7s %8s %8s %6s %6s"
+        % ("frames x px -> px", "ms", "new", "MB", "new", "bytes", "new", "fr", "new")
+    )
+    with CONTEXT.Pool(1) as pool:
+        animations = pool.starmap(animation, ANIMATIONS)
+    for ((frames, px), data) in zip(ANIMATIONS, animations):
+        for size in SIZES:
+            before = run(all_frames, data, size, repetitions)
+            after = run(resize_animated_gif, data, size, repetitions)
+            print(
+                "%-20s %8.1f %8.1f %7.1f %7.1f %8i %8i %6i %6i"
+                % (
+                    "%i x %i -> %i" % (frames, px, size),
+                    before[0],
+                    after[0],
+                    before[1],
+                    after[1],
+                    before[2],
+                    after[2],
+                    before[3],
+                    after[3],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark PNG encoding of generated default avatars: bytes and time of
+a plain PNG (as the generators used to save them) vs. encode_png()
+
+Usage: python benchmarks/png.py [--repetitions N]
+"""
+import argparse
+import hashlib
+import os
+import statistics
+import sys
+import time
+from io import BytesIO
+
+import django
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ivatar.settings")
+django.setup()
+# pylint: disable=wrong-import-position
+from ivatar.generators import GENERATORS, encode_png  # noqa: E402
+from ivatar.settings import GENERATED_AVATAR_MASTER_SIZE  # noqa: E402
+
+SIZES = (16, 32, 48, 80, 128, 256, 512)
+DIGESTS = [hashlib.md5(b"%i" % i).hexdigest() for i in range(10)]
+
+
+def plain_png(img, stored=False):  # pylint: disable=unused-argument
+    """
+    Encode as the generators used to
+    """
+    output = BytesIO()
+    img.save(output, "PNG")
+    return output.getvalue()
+
+
+def measure(encode, images, repetitions):
+    """
+    Return the mean size (bytes) and median time (ms) of encoding images
+    """
+    sizes = []
+    times = []
+    for (img, stored) in images:
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            data = encode(img, stored)
+            times.append((time.perf_counter() - start) * 1000)
+        sizes.append(len(data))
+    return (statistics.mean(sizes), statistics.median(times))
+
+
+def main():
+    """
+    Run the benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--repetitions",
+        type=int,
+        default=5,
+        help="Repetitions per measurement (default: 5)",
+    )
+    repetitions = parser.parse_args().repetitions
+    if repetitions < 1:
+        parser.error("at least 1 repetition is needed")
+    print(
+        "%-18s %9s %9s %6s %9s %9s"
+        % ("generator size", "bytes", "new", "saved", "ms", "new")
+    )
+    for (name, generator) in GENERATORS.items():
+        masters = [
+            generator(digest, GENERATED_AVATAR_MASTER_SIZE, roboset="any")
+            for digest in DIGESTS
+        ]
+        for size in SIZES:
+            images = []
+            for master in masters:
+                img = master.copy()
+                if size < GENERATED_AVATAR_MASTER_SIZE:
+                    img.thumbnail((size, size), Image.ANTIALIAS)
+                images.append((img, size == GENERATED_AVATAR_MASTER_SIZE))
+            (before, before_ms) = measure(plain_png, images, repetitions)
+            (after, after_ms) = measure(encode_png, images, repetitions)
+            print(
+                "%-18s %9i %9i %5.0f%% %9.2f %9.2f"
+                % (
+                    "%s %i" % (name, size),
+                    before,
+                    after,
+                    100 - after * 100 / before,
+                    before_ms,
+                    after_ms,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark decoding and resizing photos: with full decoding, reduced by
+thumbnail() only (reducing_gap, see ivatar.utils.RESIZE_REDUCING_GAP), and
+with JPEGs decoded at a reduced scale up front (ivatar.utils.JPEG_DRAFT_GAP)
+
+Usage: python benchmarks/resize.py [--repetitions N]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+from ivatar.utils import JPEG_DRAFT_GAP, RESIZE_REDUCING_GAP  # noqa: E402
+from ivatar.utils import normalize_image, resize_image  # noqa: E402
+
+SIZES = (16, 32, 48, 64, 80, 128, 256, 512)
+
+
+def photo(width, height, pil_format="JPEG"):
+    """
+    Return a photo-like test image: gradients, shapes and sensor noise,
+    so it compresses about as well as a real photo
+    """
+    img = Image.linear_gradient("L").resize((width, height))
+    img = Image.merge(
+        "RGB",
+        (img, img.rotate(90).resize((width, height)), Image.new("L", img.size, 96)),
+    )
+    draw = ImageDraw.Draw(img)
+    for i in range(1, 8):
+        box = (width * i // 10, height * i // 12, width * i // 5, height * i // 6)
+        draw.ellipse(box, fill=(40 * i, 255 - 30 * i, 20 * i))
+    img = img.filter(ImageFilter.GaussianBlur(2))
+    noise = Image.effect_noise((width, height), 24).convert("RGB")
+    img = Image.blend(img, noise, 0.15)
+    output = BytesIO()
+    img.save(output, pil_format, quality=90)
+    return output.getvalue()
+
+
+def timed(func, repetitions):
+    """
+    Return the median time of calling func, in milliseconds
+    """
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def compare(label, func, repetitions):
+    """
+    Print the times of func with full decoding, reduced by thumbnail() and
+    drafted, and how much faster drafting is than the one before
+    """
+    full = timed(lambda: func(None, None), repetitions)
+    thumbnail = timed(lambda: func(RESIZE_REDUCING_GAP, None), repetitions)
+    draft = timed(lambda: func(RESIZE_REDUCING_GAP, JPEG_DRAFT_GAP), repetitions)
+    print(
+        "%-28s %9.2f %9.2f %9.2f %7.1fx"
+        % (label, full, thumbnail, draft, thumbnail / draft)
+    )
+
+
+def main():
+    """
+    Run the benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--repetitions",
+        type=int,
+        default=20,
+        help="Repetitions per measurement (default: 20)",
+    )
+    repetitions = parser.parse_args().repetitions
+    if repetitions < 1:
+        parser.error("at least 1 repetition is needed")
+    corpus = {
+        "master 1024x1024 jpg": (photo(1024, 1024), "JPEG"),
+        "crop 512x512 jpg": (photo(512, 512), "JPEG"),
+        "master 1024x768 png": (photo(1024, 768, "PNG"), "PNG"),
+    }
+    print(
+        "%-28s %9s %9s %9s %8s" % ("median ms", "full", "thumbnail", "draft", "speedup")
+    )
+    for (name, (data, pil_format)) in corpus.items():
+        for size in SIZES:
+            compare(
+                "%s -> %i" % (name, size),
+                lambda gap, draft, d=data, s=size, f=pil_format: resize_image(
+                    d, s, f, 85, reducing_gap=gap, draft_gap=draft
+                ),
+                repetitions,
+            )
+
+    # Ingest, ie. normalizing uploads straight from a camera
+    for (width, height) in ((4032, 3024), (6000, 4000)):
+        data = photo(width, height)
+        compare(
+            "upload %ix%i jpg" % (width, height),
+            # Not drafted: the masters are kept at full quality
+            lambda gap, _, d=data: normalize_image(
+                d, 1024, "JPEG", 85, reducing_gap=gap
+            ),
+            max(1, repetitions // 4),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark serving avatars: latency (p50, p99), throughput and peak memory
+of AvatarImageView for stored JPEG, PNG and GIF photos and for the
+generated defaults, and of GravatarProxyView against a local stub of
+Gravatar, each at several sizes, with the caches cold (miss) and warm (hit)
+
+Every scenario runs in a process of its own, so the peak memory (how much
+serving grows the peak RSS beyond the one before the first request, and
+the peak of the memory Python allocates while serving one request) is
+its own. The photos are kept in a test database and the caches and
+stores in a temporary directory, so nothing in use is touched. The
+results are written as JSON, to compare them between releases.
+
+Usage: python benchmarks/run.py [--requests N] [--sizes 32,80,512]
+           [--defaults mmng,retro] [--scenarios 'photo/*'] [--output FILE]
+"""
+import argparse
+import fnmatch
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+import django
+import PIL
+from PIL import Image, ImageChops
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ivatar.settings")
+django.setup()
+# pylint: disable=wrong-import-position
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.cache import cache, caches  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+
+from ivatar.generators import GENERATED_DEFAULTS, generated_store  # noqa: E402
+from ivatar.gravatar import gravatar_client, gravatar_images  # noqa: E402
+from ivatar.ivataraccount.models import ConfirmedEmail, Photo  # noqa: E402
+from ivatar.ivataraccount.models import PhotoRendition  # noqa: E402
+from ivatar.response_cache import memory_cache  # noqa: E402
+from ivatar.settings import IVATAR_VERSION  # noqa: E402
+
+SIZES = (32, 80, 512)
+PHOTO_FORMATS = ("jpg", "png", "gif")
+# What browsers ask for
+ACCEPT = "image/avif,image/webp,*/*"
+GRAVATAR_DIGEST = "%032x" % 0xC0FFEE
+CONTEXT = multiprocessing.get_context("spawn")
+
+
+class GravatarStub(BaseHTTPRequestHandler):
+    """
+    Stands in for secure.gravatar.com, answering with a PNG of the
+    requested size for every digest
+    """
+
+    protocol_version = "HTTP/1.1"
+    images = {}
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Answer like Gravatar would
+        """
+        size = int(parse_qs(urlsplit(self.path).query).get("s", ["80"])[0])
+        if size not in self.images:
+            data = BytesIO()
+            photo_image(size).save(data, "PNG")
+            self.images[size] = data.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.images[size])))
+        self.end_headers()
+        self.wfile.write(self.images[size])
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def photo_image(size):
+    """
+    Return a test image with some detail (as photos have), not just a few
+    colors
+    """
+    return Image.merge(
+        "RGB",
+        (
+            Image.effect_mandelbrot((size, size), (-2, -1.5, 1, 1.5), 100),
+            Image.linear_gradient("L").resize((size, size)),
+            Image.effect_noise((size, size), 64),
+        ),
+    )
+
+
+def photo_data(imgformat):
+    """
+    Return a test photo: a 1024px JPEG, a 1024px PNG with alpha or a 256px
+    GIF animated with 30 frames
+    """
+    output = BytesIO()
+    if imgformat == "gif":
+        img = photo_image(256)
+        frames = [ImageChops.offset(img, i * 8, i * 8) for i in range(30)]
+        frames[0].save(
+            output,
+            "GIF",
+            save_all=True,
+            append_images=frames[1:],
+            duration=50,
+            loop=0,
+        )
+    elif imgformat == "png":
+        img = photo_image(1024)
+        img.putalpha(Image.radial_gradient("L").resize((1024, 1024)))
+        img.save(output, "PNG")
+    else:
+        photo_image(1024).save(output, "JPEG", quality=90)
+    return output.getvalue()
+
+
+def setup(environment):
+    """
+    Point the database, caches and stores of this process at the ones of
+    the benchmark
+    """
+    setup_test_environment()
+    override_settings(
+        CACHES={
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            },
+            "filesystem": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": os.path.join(environment["tmpdir"], "cache"),
+                "TIMEOUT": 900,
+            },
+        }
+    ).enable()
+    generated_store.location = os.path.join(environment["tmpdir"], "generated")
+    gravatar_images.store.location = os.path.join(environment["tmpdir"], "gravatar")
+    gravatar_client.base_url = environment["gravatar"]
+    if "database" in environment:
+        connection.settings_dict["NAME"] = environment["database"]
+
+
+def clear_caches():
+    """
+    Forget about everything served, rendered, generated or fetched before
+    """
+    memory_cache.clear()
+    cache.clear()
+    caches["filesystem"].clear()
+    PhotoRendition.objects.all().delete()  # pylint: disable=no-member
+    shutil.rmtree(generated_store.location, ignore_errors=True)
+    shutil.rmtree(gravatar_images.store.location, ignore_errors=True)
+
+
+def peak_rss():
+    """
+    Return the peak RSS (MB) of this process
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(environment, url, miss, requests, accept):
+    """
+    Request url (in a process of its own) and return the latencies (ms),
+    growth of the peak RSS (MB) over the one before the first request,
+    peak memory (MB) allocated while serving a request, and what was served
+    """
+    setup(environment)
+    client = Client()
+    baseline = peak_rss()
+    # Get imports, connections etc. out of the way, and fill the caches
+    response = client.get(url, HTTP_ACCEPT=accept)
+    latencies = []
+    for _ in range(requests):
+        if miss:
+            clear_caches()
+        start = time.perf_counter()
+        response = client.get(url, HTTP_ACCEPT=accept)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError("%s: status %i" % (url, response.status_code))
+    # Tracing slows down every allocation, so it's done in a request of its
+    # own rather than in the timed ones
+    if miss:
+        clear_caches()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    client.get(url, HTTP_ACCEPT=accept)
+    request_peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return {
+        "latencies": latencies,
+        "baseline_rss_mb": baseline,
+        "peak_rss_growth_mb": peak_rss() - baseline,
+        "request_peak_mb": request_peak / 1024 / 1024,
+        "content_type": response["Content-Type"],
+        "bytes": len(response.content),
+    }
+
+
+def scenarios(sizes, defaults, digests):
+    """
+    Yield name, view and URL of every scenario, run with cold and warm caches
+    """
+    for size in sizes:
+        for imgformat in PHOTO_FORMATS:
+            yield (
+                "photo/%s/%i" % (imgformat, size),
+                "AvatarImageView",
+                "/avatar/%s?s=%i" % (digests[imgformat], size),
+            )
+        for default in defaults:
+            yield (
+                "default/%s/%i" % (default, size),
+                "AvatarImageView",
+                "/avatar/%s?s=%i&d=%s&forcedefault=y"
+                % (GRAVATAR_DIGEST, size, default),
+            )
+        yield (
+            "gravatarproxy/%i" % size,
+            "GravatarProxyView",
+            "/gravatarproxy/%s?s=%i" % (GRAVATAR_DIGEST, size),
+        )
+
+
+def create_photos():
+    """
+    Store a photo of every format, return the digests to request them by
+    """
+    user = User.objects.create_user(username="benchmark", password="benchmark")
+    digests = {}
+    for imgformat in PHOTO_FORMATS:
+        (confirmed_id, _) = ConfirmedEmail.objects.create_confirmed_email(
+            user, "%s@benchmark.invalid" % imgformat, False
+        )
+        photo = Photo(user=user, ip_address="127.0.0.1", data=photo_data(imgformat))
+        photo.save()
+        confirmed = ConfirmedEmail.objects.get(pk=confirmed_id)
+        confirmed.set_photo(photo)
+        digests[imgformat] = confirmed.digest
+    return digests
+
+
+def run(args, environment):
+    """
+    Run the scenarios and return their results
+    """
+    digests = create_photos()
+    results = []
+    for (name, view, url) in scenarios(args.sizes, args.defaults, digests):
+        for miss in (True, False):
+            name_cache = "%s/%s" % (name, "miss" if miss else "hit")
+            if not fnmatch.fnmatch(name_cache, args.scenarios):
+                continue
+            with CONTEXT.Pool(1) as pool:
+                result = pool.apply(
+                    measure, (environment, url, miss, args.requests, args.accept)
+                )
+            latencies = result.pop("latencies")
+            results.append(
+                {
+                    "name": name_cache,
+                    "view": view,
+                    "url": url,
+                    "cache": "miss" if miss else "hit",
+                    "p50_ms": statistics.median(latencies),
+                    "p99_ms": statistics.quantiles(
+                        latencies, n=100, method="inclusive"
+                    )[98],
+                    "throughput_rps": len(latencies) * 1000 / sum(latencies),
+                    **result,
+                }
+            )
+            print(
+                "%-32s p50 %8.2f ms  p99 %8.2f ms  %8.1f/s  %6.1f MB  %6.1f MB"
+                % (
+                    name_cache,
+                    results[-1]["p50_ms"],
+                    results[-1]["p99_ms"],
+                    results[-1]["throughput_rps"],
+                    results[-1]["peak_rss_growth_mb"],
+                    results[-1]["request_peak_mb"],
+                ),
+                file=sys.stderr,
+            )
+    return results
+
+
+def main():
+    """
+    Run the benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=100,
+        help="Requests per scenario (default: 100)",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        default=SIZES,
+        help="Comma separated sizes (default: %s)" % ",".join(map(str, SIZES)),
+    )
+    parser.add_argument(
+        "--defaults",
+        type=lambda defaults: defaults.split(","),
+        default=GENERATED_DEFAULTS,
+        help="Comma separated generated defaults (default: all)",
+    )
+    parser.add_argument(
+        "--accept",
+        default=ACCEPT,
+        help="Accept header to request with (default: %s)" % ACCEPT,
+    )
+    parser.add_argument(
+        "--scenarios",
+        default="*",
+        help="Only run the scenarios matching this pattern, eg. 'photo/*/hit'",
+    )
+    parser.add_argument("--output", help="File to write the JSON to (default: stdout)")
+    args = parser.parse_args()
+    if args.requests < 2:
+        parser.error("at least 2 requests are needed for percentiles")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GravatarStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        environment = {
+            "tmpdir": tmpdir,
+            "gravatar": "http://127.0.0.1:%i/avatar/" % server.server_port,
+        }
+        setup(environment)
+        if connection.vendor == "sqlite":
+            # Shared with the processes running the scenarios
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                tmpdir, "db.sqlite3"
+            )
+        old_name = connection.settings_dict["NAME"]
+        environment["database"] = connection.creation.create_test_db(verbosity=0)
+        try:
+            results = run(args, environment)
+        finally:
+            # Photos might be kept outside of the database
+            for photo in Photo.objects.all():
+                photo.delete()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            server.shutdown()
+
+    report = {
+        "ivatar": IVATAR_VERSION,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "pillow": PIL.__version__,
+        "requests": args.requests,
+        "accept": args.accept,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
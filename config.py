@@ -78,6 +78,53 @@ MAX_PHOTO_SIZE = 10485760  # in bytes
 MAX_PIXELS = 7000
 AVATAR_MAX_SIZE = 512
 JPEG_QUALITY = 85
+# New photos are scaled down to fit into this (leaving some room for
+# cropping them), so rendering never has to decode huge originals
+PHOTO_MASTER_MAX_SIZE = 2 * AVATAR_MAX_SIZE
+
+# Animated GIFs are resized one frame at a time. Animations with more
+# frames than this, or more pixels in all resized frames together, lose
+# frames (evenly spread) to stay within these
+ANIMATION_MAX_FRAMES = 100
+ANIMATION_MAX_PIXELS = 32 * 1024 * 1024
+# New animated photos keep all of their frames, they're only decimated when
+# rendered. Only animations beyond these (much higher) bounds lose frames
+# when they're uploaded
+PHOTO_MASTER_MAX_FRAMES = 1000
+PHOTO_MASTER_MAX_PIXELS = 256 * 1024 * 1024
+
+# Formats avatars are served in, rather than their own (PNG, JPEG, ...),
+# if the client accepts them (or asks for one with ?format=), in order of
+# preference. AVIF needs Pillow with AVIF support (eg. pillow-avif-plugin)
+AVATAR_FORMATS = ["avif", "webp"]
+
+# Sizes photos get pre-rendered at, once they are cropped. Any other
+# size is rendered on its first request and stored for later use
+PHOTO_RENDITION_SIZES = [16, 24, 32, 48, 64, 80, 96, 128, 256, 512]
+
+# Where the image data of photos is kept: "db" (in the database), "file"
+# (below PHOTO_STORAGE_DIR, which all hosts must share) or "s3" (in a
+# bucket of an S3-compatible object store, needs boto3). Photos stored
+# before are moved with `./manage.py migrate_photo_storage`
+PHOTO_STORAGE = "db"
+PHOTO_STORAGE_DIR = "/var/lib/ivatar/photos"
+PHOTO_STORAGE_S3 = {
+    "bucket": "ivatar-photos",
+    "prefix": "",
+    "endpoint_url": None,  # eg. for MinIO
+    "access_key": None,
+    "secret_key": None,
+    "region": None,
+}
+
+# Images are rendered (decoded, resized, encoded or generated) by a pool
+# of RENDER_WORKERS processes, so web workers can be sized for I/O and
+# render workers for CPU; 0 renders in the web workers. Once
+# RENDER_MAX_PENDING renders are waiting for a render worker, or a render
+# takes longer than RENDER_TIMEOUT, a static default image is served
+RENDER_WORKERS = 0
+RENDER_MAX_PENDING = 32
+RENDER_TIMEOUT = 10  # in seconds
 
 # I'm not 100% sure if single character domains are possible
 # under any tld... so MIN_LENGTH_EMAIL/_URL, might be +1
@@ -209,6 +256,58 @@ CACHE_IMAGES_MAX_AGE = 5 * 60
 
 CACHE_RESPONSE = True
 
+# Size limit of the in-memory (per process) cache in front of the
+# filesystem cache, for the most requested avatars; 0 disables it
+CACHE_RESPONSE_MEMORY_MAX_BYTES = 32 * 1024 * 1024
+
+# Generated default avatars (monsterid, robohash, ...) never change, so
+# they're kept in a persistent store on disk, shared by all worker
+# processes; the least recently used ones are evicted, once the store
+# exceeds its size limit. A limit of 0 disables the store
+GENERATED_AVATAR_STORE_DIR = "/var/tmp/ivatar_generated"
+GENERATED_AVATAR_STORE_MAX_BYTES = 1024 * 1024 * 1024
+# Generators render every digest only once, at this size, and all other
+# sizes are scaled down from there; None renders every requested size
+GENERATED_AVATAR_MASTER_SIZE = 512
+
+# Gravatar, as used by the proxy; tests point this at a local stub server
+GRAVATAR_BASE_URL = "https://secure.gravatar.com/avatar/"
+# Timeouts adapt to the latency of Gravatar, but stay within these limits
+GRAVATAR_TIMEOUT = 5  # in seconds
+GRAVATAR_TIMEOUT_MIN = 0.5  # in seconds
+# Circuit breaker, shared by all workers through the default cache: after
+# GRAVATAR_BREAKER_FAILURES failed (or slower than GRAVATAR_SLOW) fetches
+# within GRAVATAR_BREAKER_WINDOW, Gravatar isn't asked for
+# GRAVATAR_BREAKER_RESET; then a single fetch probes if it's back
+GRAVATAR_SLOW = 2  # in seconds
+GRAVATAR_BREAKER_FAILURES = 10
+GRAVATAR_BREAKER_WINDOW = 30  # in seconds
+GRAVATAR_BREAKER_RESET = 30  # in seconds
+# Keep-alive connections to Gravatar, per worker process
+GRAVATAR_MAX_CONNECTIONS = 20
+# Images found on Gravatar are kept in a persistent store on disk (the
+# least recently used ones are evicted, once it exceeds its size limit).
+# Once older than GRAVATAR_CACHE_TIMEOUT, they're refreshed in the
+# background, while still being served; once older than
+# GRAVATAR_STALE_MAX_AGE, they're only served if Gravatar fails
+GRAVATAR_STORE_DIR = "/var/tmp/ivatar_gravatar"
+GRAVATAR_STORE_MAX_BYTES = 512 * 1024 * 1024
+GRAVATAR_CACHE_TIMEOUT = 15 * 60  # in seconds
+GRAVATAR_STALE_MAX_AGE = 7 * 24 * 60 * 60  # in seconds
+# How long the proxy remembers digests Gravatar has no image for
+GRAVATAR_MISSING_CACHE_TIMEOUT = 60  # in seconds
+
+# Access counts are buffered and written to the database in bulk:
+# "process" keeps them per worker process and writes them out every
+# ACCESS_COUNT_FLUSH_INTERVAL seconds, "cache" adds them up in the default
+# cache, from where `./manage.py flush_access_counts` writes them out
+ACCESS_COUNT_BACKEND = "process"
+ACCESS_COUNT_FLUSH_INTERVAL = 60  # in seconds
+# Whether worker processes write out the counts buffered on exit. Counts
+# are only written to the database they were counted against, not those
+# of tests (whichever runner they use) to the real one
+ACCESS_COUNT_FLUSH_AT_EXIT = True
+
 # Trusted URLs for default redirection
 TRUSTED_DEFAULT_URLS = [
     {"schemes": ["https"], "host_equals": "ui-avatars.com", "path_prefix": "/api/"},
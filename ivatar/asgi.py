@@ -0,0 +1,18 @@
+"""
+ASGI config for ivatar project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Running under ASGI (eg. with uvicorn), the Gravatar proxy doesn't block a
+worker while waiting for Gravatar.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ivatar.settings")
+
+application = get_asgi_application()  # pylint: disable=invalid-name
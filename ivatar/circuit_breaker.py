@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Circuit breaker for upstream services
+
+The state lives in the default cache, so all worker processes see the
+same state: once too many calls fail within a time window, the breaker
+trips (opens) and further calls are refused right away. After a while,
+a single call is let through (half-open), to probe if the upstream is
+back; if it succeeds, the breaker closes again, if not, it trips again.
+"""
+from django.core.cache import cache
+
+
+class CircuitOpenError(Exception):
+    """
+    The call was refused, as the circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker, sharing its state through the default cache
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, max_failures, window, reset_timeout):
+        self.name = name
+        self.max_failures = max_failures
+        self.window = window
+        self.reset_timeout = reset_timeout
+
+    def _key(self, part):
+        return "circuit_breaker:%s:%s" % (self.name, part)
+
+    async def state(self):
+        """
+        Return the current state
+        """
+        values = await cache.aget_many([self._key("open"), self._key("tripped")])
+        if self._key("open") in values:
+            return self.OPEN
+        if self._key("tripped") in values:
+            return self.HALF_OPEN
+        return self.CLOSED
+
+    async def allow(self):
+        """
+        Return if a call may go through
+        """
+        state = await self.state()
+        if state == self.HALF_OPEN:
+            # Only a single probe, for all workers
+            return await cache.aadd(self._key("probe"), True, self.reset_timeout)
+        return state == self.CLOSED
+
+    async def record_success(self):
+        """
+        A call succeeded; after a successful probe the breaker closes
+        """
+        if await cache.aget(self._key("tripped")):
+            await self.reset()
+
+    async def record_failure(self):
+        """
+        A call failed; trips the breaker, if there were too many failures
+        or the probe failed
+        """
+        key = self._key("failures")
+        await cache.aadd(key, 0, self.window)
+        try:
+            failures = await cache.aincr(key)
+        except ValueError:
+            # Window expired in the meantime
+            failures = 1
+        if failures >= self.max_failures or await cache.aget(self._key("tripped")):
+            await self.trip()
+
+    async def trip(self):
+        """
+        Open the breaker for reset_timeout seconds
+        """
+        await cache.aset(self._key("open"), True, self.reset_timeout)
+        await cache.aset(self._key("tripped"), True, None)
+        await cache.adelete_many([self._key("failures"), self._key("probe")])
+
+    async def reset(self):
+        """
+        Close the breaker
+        """
+        await cache.adelete_many(
+            [
+                self._key("open"),
+                self._key("tripped"),
+                self._key("failures"),
+                self._key("probe"),
+            ]
+        )
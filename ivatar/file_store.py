@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent, size-bounded store for binary data on the local filesystem
+
+Unlike the response cache, entries do not expire; they are only evicted
+(least recently used first) once the store grows over its budget. As it
+lives on the filesystem, all worker processes of a host share it.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+# Reading an entry refreshes its modification time (the LRU clock),
+# but not more often than this
+TOUCH_INTERVAL = 3600  # in seconds
+# Looking for entries to evict walks the whole store, so it's done in a
+# background thread and not more often than this
+CULL_INTERVAL = 60  # in seconds
+
+
+class FileStore:
+    """
+    Key/value store, files are named after the sha256 of their key
+    """
+
+    def __init__(self, location, max_bytes, low_water=0.9):
+        self.location = location
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        # Written since the last check of the total size
+        self._written = 0
+        self._culling = False
+        self._culled = time.monotonic() - CULL_INTERVAL
+
+    @property
+    def enabled(self):
+        """
+        A store without location or budget stores nothing
+        """
+        return bool(self.location and self.max_bytes)
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.location, name[0:2], name[2:4], name)
+
+    def get(self, key):
+        """
+        Return the data stored for key or None
+        """
+        if not self.enabled:
+            return None
+        filename = self._path(key)
+        try:
+            with open(filename, "rb") as entry:
+                data = entry.read()
+            if os.stat(filename).st_mtime < time.time() - TOUCH_INTERVAL:
+                os.utime(filename)
+        except OSError:
+            return None
+        return data
+
+    def set(self, key, data):
+        """
+        Store data for key; the file is replaced atomically, so concurrent
+        readers see either the old or the new data
+        """
+        if not self.enabled:
+            return
+        filename = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            (handle, tmpname) = tempfile.mkstemp(dir=os.path.dirname(filename))
+            with os.fdopen(handle, "wb") as entry:
+                entry.write(data)
+            os.replace(tmpname, filename)
+        except OSError as exc:
+            print("Unable to store %s: %s" % (filename, exc))
+            return
+
+        with self._lock:
+            self._written += len(data)
+            # No need to look at the whole store after every write
+            due = (
+                self._written > self.max_bytes * (1 - self.low_water)
+                and not self._culling
+                and time.monotonic() - self._culled > CULL_INTERVAL
+            )
+            if due:
+                self._written = 0
+                self._culling = True
+        if due:
+            threading.Thread(target=self._cull, daemon=True).start()
+
+    def _cull(self):
+        try:
+            self.cull()
+        finally:
+            with self._lock:
+                self._culling = False
+                self._culled = time.monotonic()
+
+    def delete(self, key):
+        """
+        Remove the entry for key
+        """
+        if not self.enabled:
+            return
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def cull(self):
+        """
+        Evict the least recently used entries, if the store is over budget,
+        until it's down to low_water of its budget
+        """
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.location):
+            for filename in filenames:
+                filename = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return 0
+
+        evicted = 0
+        for (_, size, filename) in sorted(entries):
+            if total <= self.max_bytes * self.low_water:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        return evicted
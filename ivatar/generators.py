@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Default avatars we generate ourselves, from the digest of the requested
+mail address / OpenID
+"""
+import hashlib
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+from monsterid.id import build_monster as BuildMonster
+import Identicon
+from pydenticon5 import Pydenticon5
+import pagan
+from robohash import Robohash
+
+from ivatar.settings import JPEG_QUALITY
+from ivatar.settings import GENERATED_AVATAR_STORE_DIR
+from ivatar.settings import GENERATED_AVATAR_STORE_MAX_BYTES
+from ivatar.settings import GENERATED_AVATAR_MASTER_SIZE
+from .file_store import FileStore
+from .ivataraccount.models import pil_format
+from .utils import mm_ng, resize_image
+
+# Bump this, if the output of a generator changes, so no stale images
+# are served from the store
+GENERATOR_VERSION = 2
+
+generated_store = FileStore(  # pylint: disable=invalid-name
+    GENERATED_AVATAR_STORE_DIR, GENERATED_AVATAR_STORE_MAX_BYTES
+)
+
+
+def monsterid(digest, size, **kwargs):  # pylint: disable=unused-argument
+    """
+    Monster, built from parts chosen by the digest
+    """
+    return BuildMonster(seed=digest, size=(size, size))
+
+
+def robohash(digest, size, roboset="any", **kwargs):  # pylint: disable=unused-argument
+    """
+    Robot (or monster, cat, ...) of the given set
+    """
+    robot = Robohash(digest)
+    robot.assemble(roboset=roboset, sizex=size, sizey=size)
+    return robot.img
+
+
+def retro(digest, size, **kwargs):  # pylint: disable=unused-argument
+    """
+    Old-school 8-bit identicon
+    """
+    img = Image.open(BytesIO(Identicon.render(digest)))
+    return img.resize((size, size), Image.ANTIALIAS)
+
+
+def pagan_avatar(digest, size, **kwargs):  # pylint: disable=unused-argument
+    """
+    Pagan pixel-art warrior
+    """
+    return pagan.Avatar(digest).img.resize((size, size), Image.ANTIALIAS)
+
+
+def identicon(digest, size, **kwargs):  # pylint: disable=unused-argument
+    """
+    Symmetric, geometric pattern
+    """
+    p = Pydenticon5()  # pylint: disable=invalid-name
+    # In order to make use of the whole 32 bytes digest, we need to redigest them.
+    newdigest = hashlib.md5(bytes(digest, "utf-8")).hexdigest()
+    return p.draw(newdigest, size, 0)
+
+
+def mmng(digest, size, **kwargs):  # pylint: disable=unused-argument
+    """
+    Mystery man, colored and shaped after the digest
+    """
+    return mm_ng(idhash=digest, size=size)
+
+
+GENERATORS = {
+    "monsterid": monsterid,
+    "robohash": robohash,
+    "retro": retro,
+    "pagan": pagan_avatar,
+    "identicon": identicon,
+    "mmng": mmng,
+}
+
+# Defaults we generate ourselves (rather than redirecting somewhere)
+GENERATED_DEFAULTS = tuple(GENERATORS)
+
+
+def palettize(img):
+    """
+    Return img as palette image, if that's possible without losing anything
+    (ie. it has 256 colors at most, as identicons, mmng etc. do), else img
+    """
+    if img.mode not in ("RGB", "RGBA"):
+        return img
+    colors = img.getcolors(256)
+    if colors is None:
+        return img
+    method = Image.Quantize.MEDIANCUT
+    if img.mode == "RGBA":
+        method = Image.Quantize.FASTOCTREE
+    palettized = img.quantize(len(colors), method=method)
+    # The octree may merge colors, even if there are only a few
+    if ImageChops.difference(palettized.convert(img.mode), img).getbbox():
+        return img
+    return palettized
+
+
+def encode_png(img, stored=False):
+    """
+    Return the PNG data of a generated avatar, as small as it gets without
+    spending too much time on it: small images and those kept in the
+    store are compressed hardest, as that costs hardly anything or is only
+    done once, for the others it costs milliseconds for a few percent
+    """
+    img = palettize(img)
+    compress_level = 9 if stored or max(img.size) <= 128 else 6
+    output = BytesIO()
+    img.save(output, "PNG", compress_level=compress_level)
+    return output.getvalue()
+
+
+def generated_avatar(default, digest, size, roboset=None, imgformat=None):
+    """
+    Return the image data (PNG, unless imgformat is given) of the generated
+    default avatar; as generating is deterministic in its arguments, the
+    result is taken from the store, if it has been generated before
+    """
+    encoder = pil_format(imgformat) if imgformat else "PNG"
+    # Scaling down the master is a lot cheaper than generating again
+    if GENERATED_AVATAR_MASTER_SIZE and size < GENERATED_AVATAR_MASTER_SIZE:
+        master = generated_avatar(
+            default, digest, GENERATED_AVATAR_MASTER_SIZE, roboset
+        )
+        if encoder != "PNG":
+            return resize_image(master, size, encoder, JPEG_QUALITY)
+        img = Image.open(BytesIO(master))
+        # Palette images would only be resized with the nearest neighbour
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        img.thumbnail((size, size), Image.ANTIALIAS)
+        return encode_png(img)
+
+    key = "%s:%s:%s:%i:%s" % (GENERATOR_VERSION, default, digest, size, roboset)
+    data = generated_store.get(key)
+    if data is None:
+        img = GENERATORS[default](digest, size, roboset=roboset)
+        data = encode_png(img, stored=True)
+        generated_store.set(key, data)
+    # Other formats are converted from the stored PNG
+    if encoder != "PNG":
+        return resize_image(data, size, encoder, JPEG_QUALITY)
+    return data
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous client for fetching images from Gravatar
+
+All fetches run in one event loop per process, in a thread of its own,
+keeping a pool of keep-alive connections, and concurrent requests for the
+same URL share one upstream fetch. Both synchronous and asynchronous
+callers hand their fetches to it: under WSGI, Django runs every call of
+an asynchronous view in an event loop of its own, that would get a client
+(and connections) of its own every time. Images found are kept in a
+persistent store and served from there, while being refreshed in the
+background once outdated.
+"""
+import asyncio
+import atexit
+import contextvars
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from io import BytesIO
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from PIL import Image
+
+from ivatar.settings import GRAVATAR_BASE_URL, GRAVATAR_TIMEOUT
+from ivatar.settings import GRAVATAR_MAX_CONNECTIONS
+from ivatar.settings import GRAVATAR_STORE_DIR, GRAVATAR_STORE_MAX_BYTES
+from ivatar.settings import GRAVATAR_CACHE_TIMEOUT, GRAVATAR_STALE_MAX_AGE
+from ivatar.settings import GRAVATAR_MISSING_CACHE_TIMEOUT
+from ivatar.settings import GRAVATAR_TIMEOUT_MIN, GRAVATAR_SLOW
+from ivatar.settings import GRAVATAR_BREAKER_FAILURES, GRAVATAR_BREAKER_WINDOW
+from ivatar.settings import GRAVATAR_BREAKER_RESET
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .file_store import FileStore
+from .ivataraccount.models import file_format
+
+
+class GravatarError(Exception):
+    """
+    Gravatar failed to answer (properly)
+    """
+
+
+class GravatarNotAskedError(GravatarError):
+    """
+    Gravatar wasn't even asked, as the circuit breaker is open
+    """
+
+
+# Timeouts adapt to the latency of recent fetches: they're a multiple of
+# the 99th percentile of those, once there are enough samples
+LATENCY_SAMPLES = 200
+LATENCY_SAMPLES_MIN = 20
+LATENCY_TIMEOUT_FACTOR = 3
+
+
+class GravatarClient:
+    """
+    Pooled, coalescing client for Gravatar
+    """
+
+    def __init__(
+        self,
+        base_url,
+        timeout,
+        max_connections,
+        min_timeout=None,
+        breaker=None,
+        slow=None,
+    ):  # pylint: disable=too-many-arguments
+        self.base_url = base_url
+        self.timeout = timeout
+        self.min_timeout = min_timeout or timeout
+        self.max_connections = max_connections
+        self.breaker = breaker
+        # Fetches slower than this count as failures for the breaker
+        self.slow = slow
+        # httpx clients are bound to the event loop they're used in
+        self._clients = weakref.WeakKeyDictionary()
+        self._inflight = weakref.WeakKeyDictionary()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def url(self, digest, size, default=None):
+        """
+        Return the Gravatar URL for the given digest, size and default
+        """
+        url = "%s%s?s=%i" % (self.base_url, digest, size)
+        if default:
+            url += "&d=%s" % default
+        return url
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+            self._clients[loop] = client
+        return client
+
+    def current_timeout(self):
+        """
+        Return the timeout for the next fetch, derived from the latency
+        of recent fetches, but within min_timeout and timeout
+        """
+        if len(self._latencies) < LATENCY_SAMPLES_MIN:
+            return self.timeout
+        latencies = sorted(self._latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return max(self.min_timeout, min(self.timeout, p99 * LATENCY_TIMEOUT_FACTOR))
+
+    async def _fetch(self, url):
+        if self.breaker and not await self.breaker.allow():
+            raise CircuitOpenError(url)
+        start = time.monotonic()
+        try:
+            response = await self._client().get(url, timeout=self.current_timeout())
+        except httpx.HTTPError:
+            if self.breaker:
+                await self.breaker.record_failure()
+            raise
+        latency = time.monotonic() - start
+        self._latencies.append(latency)
+        if self.breaker:
+            if response.status_code >= 500 or (self.slow and latency > self.slow):
+                await self.breaker.record_failure()
+            else:
+                await self.breaker.record_success()
+        return (response.status_code, response.content)
+
+    async def fetch(self, url):
+        """
+        Return the status code and content of the response for url;
+        raises httpx.HTTPError, if there is no response at all, and
+        CircuitOpenError, if Gravatar isn't asked at all
+        """
+        loop = asyncio.get_running_loop()
+        inflight = self._inflight.setdefault(loop, {})
+        task = inflight.get(url)
+        if task is None:
+            task = loop.create_task(self._fetch(url))
+            inflight[url] = task
+            task.add_done_callback(lambda _: inflight.pop(url, None))
+        # One client giving up must not cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    async def aclose(self):
+        """
+        Close the connections of the current event loop
+        """
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+class GravatarImageStore:
+    """
+    Persistent store of images fetched from Gravatar, remembering when
+    they were fetched
+    """
+
+    def __init__(self, store, fresh_for, max_age):
+        self.store = store
+        self.fresh_for = fresh_for
+        self.max_age = max_age
+
+    def get(self, url):
+        """
+        Return content, content type and age (in seconds) of the image
+        stored for url, or None
+        """
+        data = self.store.get(url)
+        if not data:
+            return None
+        try:
+            (header, content) = data.split(b"\n", 1)
+            (fetched, content_type) = header.decode("ascii").split(" ", 1)
+            return (content, content_type, time.time() - int(fetched))
+        except ValueError:
+            return None
+
+    def set(self, url, content, content_type, fetched=None):
+        """
+        Store the image fetched from url
+        """
+        header = "%i %s\n" % (fetched or time.time(), content_type)
+        self.store.set(url, header.encode("ascii") + content)
+
+    def delete(self, url):
+        """
+        Forget about the image fetched from url
+        """
+        self.store.delete(url)
+
+
+gravatar_client = GravatarClient(  # pylint: disable=invalid-name
+    GRAVATAR_BASE_URL,
+    GRAVATAR_TIMEOUT,
+    GRAVATAR_MAX_CONNECTIONS,
+    min_timeout=GRAVATAR_TIMEOUT_MIN,
+    breaker=CircuitBreaker(
+        "gravatar",
+        GRAVATAR_BREAKER_FAILURES,
+        GRAVATAR_BREAKER_WINDOW,
+        GRAVATAR_BREAKER_RESET,
+    ),
+    slow=GRAVATAR_SLOW,
+)
+
+
+class LoopThread:
+    """
+    Event loop running in a thread of its own, for synchronous callers:
+    they all share it, and with it the connections and in-flight fetches
+    of the client, rather than each starting (and leaking) its own
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        """
+        Whether the loop has been started (in this process)
+        """
+        return self._loop is not None and self._pid == os.getpid()
+
+    def _get_loop(self):
+        with self._lock:
+            # A forked worker process doesn't have the thread of its parent
+            if not self.running:
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                threading.Thread(
+                    target=self._loop.run_forever, name="gravatar", daemon=True
+                ).start()
+            return self._loop
+
+    def submit(self, coro):
+        """
+        Schedule the coroutine in the loop, started on first use, and
+        return its (concurrent.futures) future
+        """
+        # Not in the context of the caller: it might refer to the executor
+        # of a request (for thread sensitive calls), gone once answered
+        return contextvars.Context().run(
+            asyncio.run_coroutine_threadsafe, coro, self._get_loop()
+        )
+
+    def run(self, coro):
+        """
+        Run the coroutine in the loop, started on first use, and return
+        its result
+        """
+        return self.submit(coro).result()
+
+    def stop(self):
+        """
+        Stop the loop (the next run starts a new one)
+        """
+        with self._lock:
+            loop = self._loop if self.running else None
+            self._loop = None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+
+
+gravatar_images = GravatarImageStore(  # pylint: disable=invalid-name
+    FileStore(GRAVATAR_STORE_DIR, GRAVATAR_STORE_MAX_BYTES),
+    GRAVATAR_CACHE_TIMEOUT,
+    GRAVATAR_STALE_MAX_AGE,
+)
+
+
+async def store_call(method, *args):
+    """
+    Call a method of the (file system backed) store in a thread, rather
+    than blocking the event loop on disk I/O
+    """
+    return await sync_to_async(method, thread_sensitive=False)(*args)
+
+
+async def fetch_image(url, missing_key=None):
+    """
+    Fetch the image at url from Gravatar and store it; returns content and
+    content type, or None if Gravatar has no image (only when asked with
+    d=404, missing_key then remembers that). Raises GravatarError, if
+    Gravatar failed, GravatarNotAskedError, if it wasn't asked at all
+    """
+    try:
+        (status, content) = await gravatar_client.fetch(url)
+    except CircuitOpenError as exc:
+        raise GravatarNotAskedError(url) from exc
+    except httpx.HTTPError as exc:
+        print("Gravatar fetch failed with URL error: %s" % exc)
+        raise GravatarError(url) from exc
+    if status == 404 and missing_key:
+        # Doesn't depend on the size, no need to ask again for others
+        await store_call(gravatar_images.delete, url)
+        await cache.aset(missing_key, True, GRAVATAR_MISSING_CACHE_TIMEOUT)
+        return None
+    if status >= 400:
+        if status not in (404, 503):
+            print(
+                "Gravatar fetch failed with an unexpected %s HTTP error: %s"
+                % (status, url)
+            )
+        raise GravatarError(url)
+
+    try:
+        img = Image.open(BytesIO(content))
+    except (ValueError, OSError) as exc:
+        print("Value error: %s" % exc)
+        raise GravatarError(url) from exc
+    content_type = "image/%s" % file_format(img.format)
+    await store_call(gravatar_images.set, url, content, content_type)
+    return (content, content_type)
+
+
+async def refresh_image(url, missing_key=None):
+    """
+    Fetch the image at url again, in the background - unless some worker
+    is at it already; returns the future of the refresh started
+    """
+    if not await cache.aadd("gravatar_refresh:%s" % url, True, GRAVATAR_TIMEOUT * 2):
+        return None
+
+    async def refresh():
+        try:
+            await fetch_image(url, missing_key)
+        except GravatarError:
+            # Keep serving what we have
+            pass
+
+    # The loop of the request might not outlive it (synchronous views,
+    # async views under WSGI), the shared one does
+    return gravatar_loop.submit(refresh())
+
+
+def gravatar_url(digest, size, default=None):
+    """
+    Return the URL to ask Gravatar with for the digest, and the cache key
+    remembering that Gravatar has no image for it (None for wavatars)
+    """
+    # Wavatar is generated by Gravatar, for everything else we ask with
+    # d=404, so a single request tells us, if Gravatar has an image for
+    # this digest (and returns it), or if we're to use our default
+    if str(default) == "wavatar":
+        return (gravatar_client.url(digest, size, default), None)
+    return (gravatar_client.url(digest, size, 404), "gravatar_missing:%s" % digest)
+
+
+def stored_gravatar_image(digest, size, default=None):
+    """
+    Return what's known about the Gravatar image for the digest, without
+    asking Gravatar (and waiting for it): content and content type of the
+    stored image, False, if Gravatar has none, or None, if it's to be
+    asked. Outdated images are refreshed in the background
+    """
+    (url, missing_key) = gravatar_url(digest, size, default)
+    if missing_key and cache.get(missing_key):
+        return False
+    stored = gravatar_images.get(url)
+    if stored and stored[2] < gravatar_images.max_age:
+        if stored[2] > gravatar_images.fresh_for:
+            gravatar_loop.submit(refresh_image(url, missing_key))
+        return stored[:2]
+    return None
+
+
+async def gravatar_image(digest, size, default=None):
+    """
+    Return content and content type of the Gravatar image for the digest,
+    or None, if Gravatar has none and we're to use our default instead.
+    Raises GravatarError, if Gravatar is unavailable (failing, or not asked
+    as it failed just before) and there's no stored image to serve
+    """
+    (url, missing_key) = gravatar_url(digest, size, default)
+    if missing_key and await cache.aget(missing_key):
+        return None
+
+    stored = await store_call(gravatar_images.get, url)
+    if stored and stored[2] < gravatar_images.max_age:
+        # Serve what we have right away and update it for next time
+        if stored[2] > gravatar_images.fresh_for:
+            await refresh_image(url, missing_key)
+        return stored[:2]
+
+    if await cache.aget(url) == "err":
+        print("Cached Gravatar fetch failed with URL error: %s" % url)
+    else:
+        try:
+            return await fetch_image(url, missing_key)
+        except GravatarNotAskedError:
+            # The breaker decides, when to ask again
+            pass
+        except GravatarError:
+            await cache.aset(url, "err", 30)
+
+    # Better an outdated image than none at all
+    if stored:
+        return stored[:2]
+    raise GravatarError(url)
+
+
+gravatar_loop = LoopThread()  # pylint: disable=invalid-name
+
+
+def gravatar_image_sync(digest, size, default=None):
+    """
+    gravatar_image() for synchronous callers, run in the shared event loop
+    """
+    return gravatar_loop.run(gravatar_image(digest, size, default))
+
+
+async def gravatar_image_shared(digest, size, default=None):
+    """
+    gravatar_image() for asynchronous callers, run in the shared event
+    loop rather than the one of the caller, which might not outlive the
+    request (async views under WSGI)
+    """
+    return await asyncio.wrap_future(
+        gravatar_loop.submit(gravatar_image(digest, size, default))
+    )
+
+
+@atexit.register
+def close():
+    """
+    Close the connections of the shared event loop and stop it
+    """
+    if gravatar_loop.running:
+        gravatar_loop.run(gravatar_client.aclose())
+        gravatar_loop.stop()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered access counting for photos, mail addresses and OpenIDs
+
+Serving an avatar must not wait for the database, so accesses are only
+counted in memory and written out as aggregated F() updates later on:
+
+- "process": every worker process keeps its own counts and writes them
+  to the database every ACCESS_COUNT_FLUSH_INTERVAL seconds (from a
+  background thread) and on exit
+- "cache": the counts are added up in the default cache instead and
+  `./manage.py flush_access_counts` (eg. from cron) writes them to the
+  database
+"""
+import atexit
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+
+from ivatar.settings import ACCESS_COUNT_BACKEND, ACCESS_COUNT_FLUSH_INTERVAL
+from ivatar.settings import ACCESS_COUNT_FLUSH_AT_EXIT
+
+CACHE_KEY_PREFIX = "ivatar_access_count"
+# The counters to be written are listed in numbered entries, written once
+# each, this being the number of the last one; so concurrent pushes don't
+# lose each other's, and no entry outgrows the item size limit of the cache
+PENDING_CACHE_KEY = "%s_pending" % CACHE_KEY_PREFIX
+PENDING_ENTRY_SIZE = 1000
+# Where the last flush left off: (first entry to read, last entry read)
+FLUSHED_CACHE_KEY = "%s_flushed" % CACHE_KEY_PREFIX
+
+
+def write_access_counts(deltas):
+    """
+    Add the given deltas ({(model label, pk): count}) to the access_count
+    of the respective objects; objects with the same delta are updated
+    with a single query
+    """
+    grouped = defaultdict(list)
+    for (label, pk), delta in deltas.items():
+        if delta > 0:
+            grouped[(label, delta)].append(pk)
+
+    with transaction.atomic():
+        for (label, delta), pks in grouped.items():
+            apps.get_model(label).objects.filter(pk__in=pks).update(
+                access_count=F("access_count") + delta
+            )
+    return sum(deltas.values())
+
+
+def _cache_key(label, pk):
+    return "%s:%s:%s" % (CACHE_KEY_PREFIX, label, pk)
+
+
+def _pending_key(number):
+    return "%s:%i" % (PENDING_CACHE_KEY, number)
+
+
+def _next_pending_number():
+    try:
+        return cache.incr(PENDING_CACHE_KEY)
+    except ValueError:
+        cache.add(PENDING_CACHE_KEY, 0, timeout=None)
+        return cache.incr(PENDING_CACHE_KEY)
+
+
+def push_access_counts_to_cache(deltas):
+    """
+    Add the given deltas to the counters in the default cache and
+    remember the counters, which need to be written to the database
+    """
+    for (label, pk), delta in deltas.items():
+        key = _cache_key(label, pk)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # Not there yet - if somebody else was faster adding it, incr
+            if not cache.add(key, delta, timeout=None):
+                cache.incr(key, delta)
+
+    # Every push gets entries of its own, numbered atomically, rather than
+    # updating a shared one
+    pending = sorted(deltas)
+    while pending:
+        (entry, pending) = (pending[:PENDING_ENTRY_SIZE], pending[PENDING_ENTRY_SIZE:])
+        cache.set(_pending_key(_next_pending_number()), entry, timeout=None)
+
+
+def flush_access_counts_from_cache():
+    """
+    Write the counters accumulated in the default cache to the database
+    """
+    last = cache.get(PENDING_CACHE_KEY) or 0
+    (first, flushed) = cache.get(FLUSHED_CACHE_KEY) or (1, 0)
+    pending = set()
+    entries = []
+    # Entries missing after the last flush may still be being written,
+    # they're read again next time; earlier ones are gone for good
+    resume = last + 1
+    for start in range(first, last + 1, PENDING_ENTRY_SIZE):
+        numbers = range(start, min(start + PENDING_ENTRY_SIZE, last + 1))
+        values = cache.get_many([_pending_key(number) for number in numbers])
+        for number in numbers:
+            key = _pending_key(number)
+            if key in values:
+                pending.update(values[key])
+                entries.append(key)
+            elif number > flushed:
+                resume = min(resume, number)
+
+    keys = {_cache_key(label, pk): (label, pk) for (label, pk) in pending}
+    values = cache.get_many(keys.keys())
+    # Counters evicted or expired meanwhile are gone for good
+    deltas = Counter()
+    for key, value in values.items():
+        if not value:
+            cache.delete(key)
+            continue
+        # decr, rather than delete, keeps increments, which happened in
+        # the meantime (and got entries of their own); only once nothing
+        # is left, the counter goes
+        try:
+            if cache.decr(key, value) <= 0:
+                cache.delete(key)
+        except ValueError:
+            pass
+        deltas[keys[key]] = value
+    written = write_access_counts(deltas)
+    cache.delete_many(entries)
+    cache.set(FLUSHED_CACHE_KEY, (resume, last), timeout=None)
+    return written
+
+
+class AccessCounter:
+    """
+    Per process buffer of access counts
+    """
+
+    def __init__(
+        self, backend=ACCESS_COUNT_BACKEND, interval=ACCESS_COUNT_FLUSH_INTERVAL
+    ):
+        self.backend = backend
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._deltas = Counter()
+        self._last_flush = time.monotonic()
+        self._flushing = False
+        # Accesses aren't counted while paused, eg. those of cache warm-ups
+        self.paused = False
+        # Name of the database the buffered counts were counted against
+        self.database = None
+
+    def record(self, model, pk):
+        """
+        Count one access of the object of the given model and primary key
+        """
+        if self.paused:
+            return
+        with self._lock:
+            if not self._deltas:
+                self.database = connection.settings_dict["NAME"]
+            self._deltas[(model._meta.label_lower, pk)] += 1
+            due = (
+                not self._flushing
+                and time.monotonic() - self._last_flush >= self.interval
+            )
+            if due:
+                self._flushing = True
+        if due:
+            threading.Thread(target=self._background_flush, daemon=True).start()
+
+    def _take(self):
+        with self._lock:
+            deltas = self._deltas
+            self._deltas = Counter()
+            self._last_flush = time.monotonic()
+        return deltas
+
+    def _background_flush(self):
+        try:
+            self.flush()
+        except Exception as exc:  # pylint: disable=broad-except
+            print("Flushing access counts failed: %s" % exc)
+        finally:
+            self._flushing = False
+            # This thread has its own database connection
+            connection.close()
+
+    def flush(self):
+        """
+        Hand over the buffered counts, to the database or the cache,
+        depending on the backend
+        """
+        deltas = self._take()
+        if not deltas:
+            return 0
+        try:
+            if self.backend == "cache":
+                push_access_counts_to_cache(deltas)
+                return sum(deltas.values())
+            return write_access_counts(deltas)
+        except Exception:
+            # Keep the counts for the next attempt
+            with self._lock:
+                self._deltas.update(deltas)
+            raise
+
+
+access_counter = AccessCounter()  # pylint: disable=invalid-name
+
+
+def _flush_at_exit(counter=access_counter):
+    # Tests count against a throw-away database, gone by now: their counts
+    # must not end up in the one configured
+    if counter.database != connection.settings_dict["NAME"]:
+        return
+    try:
+        counter.flush()
+    except Exception:  # pylint: disable=broad-except
+        pass
+
+
+if ACCESS_COUNT_FLUSH_AT_EXIT:
+    atexit.register(_flush_at_exit)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to write buffered access counts to the database
+"""
+from django.core.management.base import BaseCommand
+
+from ivatar.ivataraccount.counters import flush_access_counts_from_cache
+
+
+class Command(BaseCommand):
+    """
+    Write the access counts accumulated in the default cache
+    (ACCESS_COUNT_BACKEND = "cache") to the database
+    """
+
+    help = "Write access counts buffered in the cache to the database"
+
+    def handle(self, *args, **options):
+        written = flush_access_counts_from_cache()
+        self.stdout.write("Flushed %i accesses" % written)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to move the image data of photos to another storage
+"""
+import hashlib
+
+from django.core.management.base import BaseCommand
+
+from ivatar.settings import PHOTO_STORAGE
+from ivatar.ivataraccount.models import Photo, release_photo_data
+from ivatar.ivataraccount.photo_storage import DatabaseStorage, get_storage
+
+
+class Command(BaseCommand):
+    """
+    Move the image data of all photos to the configured (or given) storage
+    """
+
+    help = "Move the image data of photos to the configured photo storage"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--to",
+            default=PHOTO_STORAGE,
+            help="Storage to move the image data to (default: %s)" % PHOTO_STORAGE,
+        )
+
+    def handle(self, *args, **options):
+        target = options["to"]
+        storage = get_storage(target)
+        count = 0
+        pks = (
+            Photo.objects.exclude(storage=target)  # pylint: disable=no-member
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        for pk in list(pks):
+            # One at a time, the image data can be large
+            photo = Photo.objects.get(pk=pk)  # pylint: disable=no-member
+            data = photo.get_data()
+            digest = photo.digest or hashlib.sha256(data).hexdigest()
+            if target == DatabaseStorage.name:
+                fields = {"data": data}
+            else:
+                storage.save(digest, data)
+                fields = {"data": b""}
+            # Bypass save(), the photo (and its last_modified) stays the same
+            Photo.objects.filter(pk=pk).update(  # pylint: disable=no-member
+                storage=target, digest=digest, **fields
+            )
+            release_photo_data(photo.storage, photo.digest)
+            count += 1
+        self.stdout.write("Moved %i photos to %s" % (count, target))
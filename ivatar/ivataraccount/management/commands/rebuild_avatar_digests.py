@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to (re-)build the avatar digest index
+"""
+from django.core.management.base import BaseCommand
+
+from ivatar.ivataraccount.models import AvatarDigest
+from ivatar.ivataraccount.models import ConfirmedEmail, ConfirmedOpenId
+
+
+class Command(BaseCommand):
+    """
+    Index the digests of all confirmed email addresses and OpenIDs
+    """
+
+    help = "(Re-)build the avatar digest index from confirmed mails and OpenIDs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help="Empty the index before rebuilding it",
+        )
+
+    def handle(self, *args, **options):
+        if options["clear"]:
+            AvatarDigest.objects.all().delete()  # pylint: disable=no-member
+
+        # Mails first, then OpenIDs, both in order of creation - for
+        # overlapping OpenID variations the first one wins
+        for model in (ConfirmedEmail, ConfirmedOpenId):
+            count = 0
+            for owner in model.objects.order_by("pk").iterator():
+                AvatarDigest.objects.register(owner)  # pylint: disable=no-member
+                count += 1
+            self.stdout.write(
+                "Indexed %i %s" % (count, model._meta.verbose_name_plural)
+            )
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to warm up the caches with the most requested avatars
+
+Only what's shared by the web workers is warmed up: the renditions and
+the filesystem cache of responses. The in-memory tier of the responses is
+local to a process, the one of the command is gone once it's done.
+
+The avatars are requested the way clients do, so the responses are cached
+under the keys real requests look up. Those without a photo aren't warmed
+up: what they're served depends on Gravatar, which isn't to be asked here.
+"""
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+
+from ivatar.settings import AVATAR_MAX_SIZE, PHOTO_RENDITION_SIZES
+from ivatar.settings import RENDER_WORKERS
+from ivatar.render import render_pool
+from ivatar.response_cache import memory_cache
+from ivatar.views import AvatarImageView, OUTPUT_FORMATS, ANIMATED_OUTPUT_FORMATS
+from ivatar.views import get_format
+from ivatar.ivataraccount.counters import access_counter
+from ivatar.ivataraccount.models import ConfirmedEmail, ConfirmedOpenId
+
+
+def top_owners(count):
+    """
+    Return the count most requested confirmed email addresses and OpenIDs
+    with a photo
+    """
+    owners = []
+    for model in (ConfirmedEmail, ConfirmedOpenId):
+        queryset = model.objects.filter(photo__isnull=False)
+        owners.extend(queryset.order_by("-access_count", "pk")[:count])
+    owners.sort(key=lambda owner: owner.access_count, reverse=True)
+    return owners[:count]
+
+
+def distinct_accepts(accepts=None):
+    """
+    Return one of the Accept headers for each format (and format for
+    animations) they're served in, as responses are cached per format, not
+    per header. By default, one for each format we serve
+    """
+    if accepts is None:
+        accepts = [
+            ",".join(
+                ["image/%s" % f for f in (imgformat, animatedformat) if f] + ["*/*"]
+            )
+            for imgformat in (None,) + OUTPUT_FORMATS
+            for animatedformat in (None,) + ANIMATED_OUTPUT_FORMATS
+        ]
+    factory = RequestFactory()
+    distinct = {}
+    for accept in accepts:
+        request = factory.get("/", HTTP_ACCEPT=accept)
+        formats = (get_format(request), get_format(request, ANIMATED_OUTPUT_FORMATS))
+        distinct.setdefault(formats, accept)
+    return list(distinct.values())
+
+
+class Command(BaseCommand):
+    """
+    Request the avatars of the most requested email addresses and OpenIDs,
+    so their renditions and responses are in the shared caches
+    """
+
+    help = (
+        "Warm up the shared caches (renditions and the filesystem cache of "
+        "responses) with the avatars of the most requested email addresses "
+        "and OpenIDs with a photo"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=1000,
+            help="Number of email addresses and OpenIDs (default: 1000)",
+        )
+        parser.add_argument(
+            "--sizes",
+            default=",".join(str(size) for size in PHOTO_RENDITION_SIZES),
+            help="Comma separated sizes (default: the rendition sizes)",
+        )
+        parser.add_argument(
+            "--accept",
+            action="append",
+            help="Accept header to request with, may be repeated (default: "
+            "one for each combination of image formats we serve)",
+        )
+        parser.add_argument(
+            "--default",
+            action="append",
+            default=[],
+            help="Default (d=) to request with, as clients do, besides none; "
+            "responses are cached per default. May be repeated",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=max(1, RENDER_WORKERS),
+            help="Number of avatars requested in parallel; more than one "
+            "only helps with render processes (RENDER_WORKERS), rendering "
+            "in threads holds the GIL (default: RENDER_WORKERS, at least 1)",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+        except ValueError as exc:
+            raise CommandError("Invalid sizes: %s" % options["sizes"]) from exc
+        if not all(0 < size <= AVATAR_MAX_SIZE for size in sizes):
+            raise CommandError("Sizes must be 1 to %i" % AVATAR_MAX_SIZE)
+        accepts = distinct_accepts(options["accept"])
+        owners = top_owners(options["top"])
+        avatars = [
+            (digest, size, default, accept)
+            for owner in owners
+            for digest in owner.avatar_digests()
+            for default in [None] + options["default"]
+            for size in sizes
+            for accept in accepts
+        ]
+        self.stdout.write(
+            "Warming up %i avatars of %i email addresses and OpenIDs"
+            % (len(avatars), len(owners))
+        )
+        if options["workers"] > 1 and not render_pool.workers:
+            self.stdout.write(
+                "Without render processes (RENDER_WORKERS), %i workers "
+                "render one at a time" % options["workers"]
+            )
+
+        factory = RequestFactory()
+        view = AvatarImageView.as_view()
+
+        def warm(digest, size, default, accept):
+            args = {"s": size}
+            if default:
+                args["d"] = default
+            request = factory.get("/avatar/%s" % digest, args, HTTP_ACCEPT=accept)
+            return view(request, digest=digest).status_code
+
+        statuses = Counter()
+        start = time.monotonic()
+        # Report about every 5%
+        every = max(1, len(avatars) // 20)
+        # Our own requests don't count as accesses, and the responses are
+        # only kept in the filesystem cache, not in our memory
+        access_counter.paused = True
+        max_bytes = memory_cache.max_bytes
+        memory_cache.max_bytes = 0
+        try:
+            if options["workers"] > 1:
+                with ThreadPoolExecutor(options["workers"]) as executor:
+                    futures = [executor.submit(warm, *avatar) for avatar in avatars]
+                    for future in as_completed(futures):
+                        statuses[future.result()] += 1
+                        self._progress(statuses, len(avatars), start, every)
+            else:
+                for avatar in avatars:
+                    statuses[warm(*avatar)] += 1
+                    self._progress(statuses, len(avatars), start, every)
+        finally:
+            access_counter.paused = False
+            memory_cache.max_bytes = max_bytes
+
+        elapsed = time.monotonic() - start
+        done = sum(statuses.values())
+        self.stdout.write(
+            "Warmed up %i avatars in %.1fs (%.1f/s), %i not found or failed"
+            % (done, elapsed, done / max(elapsed, 0.001), done - statuses[200])
+        )
+
+    def _progress(self, statuses, total, start, every):
+        done = sum(statuses.values())
+        if done % every == 0 and done < total:
+            elapsed = time.monotonic() - start
+            self.stdout.write(
+                "%i/%i (%.0f%%), %.1f/s"
+                % (done, total, done * 100 / total, done / max(elapsed, 0.001))
+            )
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ivataraccount", "0017_auto_20210528_1314"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PhotoRendition",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("size", models.PositiveSmallIntegerField()),
+                ("format", models.CharField(max_length=4)),
+                ("data", models.BinaryField()),
+                (
+                    "photo",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="renditions",
+                        to="ivataraccount.photo",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "photo rendition",
+                "verbose_name_plural": "photo renditions",
+                "unique_together": {("photo", "size", "format")},
+            },
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def index_digests(apps, schema_editor):
+    """
+    Fill the index with the digests of all confirmed mail addresses and
+    OpenIDs - mails first, then OpenIDs, both in order of creation, so for
+    overlapping OpenID variations the first one wins (as in the lookup
+    the index replaces)
+    """
+    AvatarDigest = apps.get_model("ivataraccount", "AvatarDigest")
+    for (model_name, owner_type, fields) in (
+        ("ConfirmedEmail", "email", ("digest", "digest_sha256")),
+        (
+            "ConfirmedOpenId",
+            "openid",
+            ("digest", "alt_digest1", "alt_digest2", "alt_digest3"),
+        ),
+    ):
+        model = apps.get_model("ivataraccount", model_name)
+        entries = []
+        for owner in model.objects.order_by("pk").iterator():
+            digests = {getattr(owner, field) for field in fields} - {None, ""}
+            entries.extend(
+                AvatarDigest(
+                    digest=digest,
+                    owner_type=owner_type,
+                    owner_id=owner.pk,
+                    photo_id=owner.photo_id,
+                )
+                for digest in digests
+            )
+            if len(entries) >= 1000:
+                AvatarDigest.objects.bulk_create(entries, ignore_conflicts=True)
+                entries = []
+        AvatarDigest.objects.bulk_create(entries, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ivataraccount", "0018_photorendition"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AvatarDigest",
+            fields=[
+                (
+                    "digest",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                (
+                    "owner_type",
+                    models.CharField(
+                        choices=[("email", "Email"), ("openid", "OpenID")], max_length=6
+                    ),
+                ),
+                ("owner_id", models.BigIntegerField()),
+                (
+                    "photo",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="ivataraccount.photo",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "avatar digest",
+                "verbose_name_plural": "avatar digests",
+                "indexes": [
+                    models.Index(
+                        fields=["owner_type", "owner_id"],
+                        name="ivataraccou_owner_t_0f1fbb_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(index_digests, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ivataraccount", "0019_avatardigest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="photo",
+            name="last_modified",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="avatardigest",
+            name="last_modified",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
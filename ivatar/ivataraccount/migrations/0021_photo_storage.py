@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ivataraccount", "0020_last_modified"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="photo",
+            name="digest",
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="photo",
+            name="storage",
+            field=models.CharField(default="db", max_length=8),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:32
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ivataraccount", "0021_photo_storage"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="photo",
+            options={
+                "base_manager_name": "objects",
+                "verbose_name": "photo",
+                "verbose_name_plural": "photos",
+            },
+        ),
+    ]
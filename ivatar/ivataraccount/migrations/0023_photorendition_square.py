@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ivataraccount", "0022_photo_base_manager"),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="photorendition",
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name="photorendition",
+            name="square",
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name="photorendition",
+            unique_together={("photo", "size", "format", "square")},
+        ),
+    ]
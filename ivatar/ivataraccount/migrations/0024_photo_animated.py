@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ivataraccount", "0023_photorendition_square"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="photo",
+            name="animated",
+            field=models.BooleanField(null=True),
+        ),
+    ]
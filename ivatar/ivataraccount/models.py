@@ -15,7 +15,10 @@ from urllib.parse import urlsplit, urlunsplit
 from PIL import Image
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.http import HttpResponseRedirect
 from django.urls import reverse_lazy, reverse
@@ -31,10 +34,13 @@ from libravatar import libravatar_url
 
 from ivatar.settings import MAX_LENGTH_EMAIL, logger
 from ivatar.settings import MAX_PIXELS, AVATAR_MAX_SIZE, JPEG_QUALITY
-from ivatar.settings import MAX_LENGTH_URL
+from ivatar.settings import MAX_LENGTH_URL, PHOTO_RENDITION_SIZES
+from ivatar.settings import PHOTO_STORAGE, PHOTO_MASTER_MAX_SIZE
 from ivatar.settings import SECURE_BASE_URL, SITE_NAME, DEFAULT_FROM_EMAIL
-from ivatar.utils import openid_variations
+from ivatar.utils import openid_variations, resize_image, normalize_image
+from ivatar.render import RenderBusyError, render_pool
 from .gravatar import get_photo as get_gravatar_photo
+from .photo_storage import DatabaseStorage, get_storage
 
 
 def file_format(image_type):
@@ -64,6 +70,8 @@ def pil_format(image_type):
         return "GIF"
     elif image_type == "webp":
         return "WEBP"
+    elif image_type == "avif":
+        return "AVIF"
 
     logger.info("Unsupported file format: %s", image_type)
     return None
@@ -117,21 +125,56 @@ class BaseAccountModel(models.Model):
         abstract = True
 
 
+class PhotoQuerySet(models.QuerySet):
+    """
+    QuerySet for photos
+    """
+
+    def with_data(self):
+        """
+        Load the image data (kept in the database) along with the photos
+        """
+        return self.defer(None)
+
+
+class PhotoManager(models.Manager.from_queryset(PhotoQuerySet)):
+    """
+    Manager for photos; the image data is large and rarely needed, so it's
+    only loaded on access (see Photo.get_data()) or if asked for explicitly
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().defer("data")
+
+
 class Photo(BaseAccountModel):
     """
     Model holding the photos and information about them
     """
 
     ip_address = models.GenericIPAddressField(unpack_ipv4=True)
+    # Only used with the "db" storage, use get_data() to read the image
     data = models.BinaryField()
     format = models.CharField(max_length=3)
+    # Storage backend holding the image data, and its address there
+    storage = models.CharField(max_length=8, default="db")
+    digest = models.CharField(max_length=64, blank=True, db_index=True)
+    # If it has more than one frame, None if not known yet (see is_animated())
+    animated = models.BooleanField(null=True)
     access_count = models.BigIntegerField(default=0, editable=False)
+    # Changes with every crop, used to validate cached copies (ETag etc.)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    objects = PhotoManager()
 
     class Meta:  # pylint: disable=too-few-public-methods
         """
         Class attributes
         """
 
+        # Also for related lookups, like ConfirmedEmail.photo
+        base_manager_name = "objects"
+
         verbose_name = _("photo")
         verbose_name_plural = _("photos")
 
@@ -176,7 +219,8 @@ class Photo(BaseAccountModel):
             print("Unable to determine format: %s" % img)  # pragma: no cover
             return False  # pragma: no cover
         self.data = data
-        super().save()
+        if self.save() is False:
+            return False
         return True
 
     def save(
@@ -185,9 +229,15 @@ class Photo(BaseAccountModel):
         """
         Override save from parent, taking care about the image
         """
+        # Image data assigned (or loaded) is (re)checked and stored; if there
+        # is none (moved out of the database or deferred), only the metadata
+        data = self.__dict__.get("data")
+        if not data and self.pk is not None:
+            return super().save(force_insert, force_update, using, update_fields)
+
         # Use PIL to read the file format
         try:
-            img = Image.open(BytesIO(self.data))
+            img = Image.open(BytesIO(data))
         # Testing? Ideas anyone?
         except Exception as exc:  # pylint: disable=broad-except
             # For debugging only
@@ -197,7 +247,59 @@ class Photo(BaseAccountModel):
         if not self.format:
             print("Format not recognized")
             return False
-        return super().save(force_insert, force_update, using, update_fields)
+        self.animated = getattr(img, "is_animated", False)
+
+        data = bytes(data)
+        if self.pk is None:
+            # New photos are normalized right away (orientation, metadata,
+            # dimensions), so that is done once and not on every rendering
+            if img.size[0] > MAX_PIXELS or img.size[1] > MAX_PIXELS:
+                print("Image dimensions are too big: %ix%i" % img.size)
+                return False
+            try:
+                data = normalize_image(
+                    data, PHOTO_MASTER_MAX_SIZE, pil_format(self.format), JPEG_QUALITY
+                )
+            except Exception as exc:  # pylint: disable=broad-except
+                print("Exception caught in Photo.save(): %s" % exc)
+                return False
+            self.data = data
+        old = (self.storage, self.digest)
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.storage = PHOTO_STORAGE
+        if self.storage != DatabaseStorage.name:
+            get_storage(self.storage).save(self.digest, data)
+            self.data = b""
+            # Keep it at hand, it's probably used right away (eg. cropping)
+            self._blob = data
+        retval = super().save(force_insert, force_update, using, update_fields)
+        if old != (self.storage, self.digest):
+            release_photo_data(*old)
+        return retval
+
+    def get_data(self):
+        """
+        Return the image data, from whichever storage holds it
+        """
+        data = self.__dict__.get("data")
+        if data:
+            return bytes(data)
+        if getattr(self, "_blob", None) is not None:
+            return self._blob
+        if self.storage == DatabaseStorage.name:
+            return bytes(self.data)
+        return get_storage(self.storage).load(self.digest)
+
+    def is_animated(self):
+        """
+        Return if the image has more than one frame; for photos saved
+        before that was recorded, it's looked up once
+        """
+        if self.animated is None:
+            img = Image.open(BytesIO(self.get_data()))
+            self.animated = getattr(img, "is_animated", False)
+            Photo.objects.filter(pk=self.pk).update(animated=self.animated)
+        return self.animated
 
     def perform_crop(self, request, dimensions, email, openid):
         """
@@ -224,7 +326,7 @@ class Photo(BaseAccountModel):
             openid.save()
 
         # Do the real work cropping
-        img = Image.open(BytesIO(self.data))
+        img = Image.open(BytesIO(self.get_data()))
 
         # This should be anyway checked during save...
         dimensions["a"], dimensions["b"] = img.size  # pylint: disable=invalid-name
@@ -276,12 +378,104 @@ class Photo(BaseAccountModel):
         self.data = data.read()
         self.save()
 
+        # Renditions of the old image are no longer valid
+        self.renditions.all().delete()
+        self.prerender()
+
         return HttpResponseRedirect(reverse_lazy("profile"))
 
+    def prerender(self, sizes=PHOTO_RENDITION_SIZES):
+        """
+        Render the photo at the given (commonly requested) sizes and
+        put the results into the rendition store
+        """
+        for size in sizes:
+            try:
+                self.get_rendition(size)
+            except RenderBusyError:
+                # Left for the first request of the size
+                break
+
+    def get_rendition(self, size, imgformat=None, square=True):
+        """
+        Return the photo resized to size x size (or, with square=False,
+        scaled down to fit into it), encoded in imgformat (or its own
+        format). The result is taken from the rendition store if it's
+        there, else it's rendered now and stored for the next request
+        """
+        imgformat = imgformat or self.format
+        data = (
+            PhotoRendition.objects.filter(  # pylint: disable=no-member
+                photo_id=self.pk, size=size, format=imgformat, square=square
+            )
+            .values_list("data", flat=True)
+            .first()
+        )
+        if data is not None:
+            return bytes(data)
+
+        data = render_pool.render(
+            resize_image,
+            self.get_data(),
+            size,
+            pil_format(imgformat),
+            JPEG_QUALITY,
+            square=square,
+        )
+        try:
+            with transaction.atomic():
+                PhotoRendition.objects.create(  # pylint: disable=no-member
+                    photo_id=self.pk,
+                    size=size,
+                    format=imgformat,
+                    square=square,
+                    data=data,
+                )
+        except IntegrityError:
+            # Another request was faster rendering the very same size
+            pass
+        return data
+
     def __str__(self):
         return "%s (%i) from %s" % (self.format, self.pk or 0, self.user)
 
 
+class PhotoRendition(models.Model):
+    """
+    Model holding resized versions of a photo, so serving an avatar
+    doesn't require decoding and resizing the original on every request
+    """
+
+    photo = models.ForeignKey(
+        Photo,
+        related_name="renditions",
+        on_delete=models.deletion.CASCADE,
+    )
+    size = models.PositiveSmallIntegerField()
+    format = models.CharField(max_length=4)
+    # Avatars are squares, thumbnails of (possibly uncropped) photos keep
+    # their aspect ratio
+    square = models.BooleanField(default=True)
+    data = models.BinaryField()
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """
+        Class attributes
+        """
+
+        verbose_name = _("photo rendition")
+        verbose_name_plural = _("photo renditions")
+        unique_together = ("photo", "size", "format", "square")
+
+    def __str__(self):
+        return "%s %ipx (%i) of photo %i" % (
+            self.format,
+            self.size,
+            self.pk or 0,
+            self.photo_id,
+        )
+
+
 # pylint: disable=too-few-public-methods
 class ConfirmedEmailManager(models.Manager):
     """
@@ -354,7 +548,15 @@ class ConfirmedEmail(BaseAccountModel):
         self.digest_sha256 = hashlib.sha256(
             self.email.strip().lower().encode("utf-8")
         ).hexdigest()
-        return super().save(force_insert, force_update, using, update_fields)
+        retval = super().save(force_insert, force_update, using, update_fields)
+        AvatarDigest.objects.register(self)
+        return retval
+
+    def avatar_digests(self):
+        """
+        Return the digests an avatar can be requested for
+        """
+        return [self.digest, self.digest_sha256]
 
     def __str__(self):
         return "%s (%i) from %s" % (self.email, self.pk, self.user)
@@ -508,12 +710,178 @@ class ConfirmedOpenId(BaseAccountModel):
             openid_variations(lowercase_url)[3].encode("utf-8")
         ).hexdigest()
 
-        return super().save(force_insert, force_update, using, update_fields)
+        retval = super().save(force_insert, force_update, using, update_fields)
+        AvatarDigest.objects.register(self)
+        return retval
+
+    def avatar_digests(self):
+        """
+        Return the digests an avatar can be requested for
+        """
+        digests = []
+        for digest in (
+            self.digest,
+            self.alt_digest1,
+            self.alt_digest2,
+            self.alt_digest3,
+        ):
+            if digest and digest not in digests:
+                digests.append(digest)
+        return digests
 
     def __str__(self):
         return "%s (%i) (%s)" % (self.openid, self.pk, self.user)
 
 
+class AvatarDigestManager(models.Manager):
+    """
+    Manager keeping the avatar digest index in sync with the
+    confirmed email addresses and OpenIDs
+    """
+
+    def register(self, owner):
+        """
+        (Re-)index all digests of the given confirmed email / OpenID
+        """
+        owner_type = AvatarDigest.owner_type_of(owner)
+        digests = owner.avatar_digests()
+        mine = self.filter(owner_type=owner_type, owner_id=owner.pk)
+        mine.exclude(digest__in=digests).delete()
+        mine.exclude(photo_id=owner.photo_id).update(
+            photo_id=owner.photo_id, last_modified=timezone.now()
+        )
+        # If somebody else already owns a digest (OpenID variations may
+        # overlap), the first one wins - that's how the lookup always worked
+        self.bulk_create(
+            [
+                AvatarDigest(
+                    digest=digest,
+                    owner_type=owner_type,
+                    owner_id=owner.pk,
+                    photo_id=owner.photo_id,
+                )
+                for digest in digests
+            ],
+            ignore_conflicts=True,
+        )
+
+    def unregister(self, owner):
+        """
+        Remove all digests of the given confirmed email / OpenID from the
+        index and hand over shared digests to the remaining owners
+        """
+        owner_type = AvatarDigest.owner_type_of(owner)
+        digests = owner.avatar_digests()
+        self.filter(owner_type=owner_type, owner_id=owner.pk).delete()
+        if owner_type == AvatarDigest.OPENID:
+            for other in ConfirmedOpenId.objects.filter(  # pylint: disable=no-member
+                Q(digest__in=digests)
+                | Q(alt_digest1__in=digests)
+                | Q(alt_digest2__in=digests)
+                | Q(alt_digest3__in=digests)
+            ).exclude(pk=owner.pk):
+                self.register(other)
+
+
+class AvatarDigest(models.Model):
+    """
+    Index of all digests we serve avatars for, so resolving a digest
+    is a single primary key lookup instead of querying every digest
+    column of the confirmed email addresses and OpenIDs
+    """
+
+    EMAIL = "email"
+    OPENID = "openid"
+    OWNER_TYPES = (
+        (EMAIL, "Email"),
+        (OPENID, "OpenID"),
+    )
+
+    digest = models.CharField(max_length=64, primary_key=True)
+    owner_type = models.CharField(max_length=6, choices=OWNER_TYPES)
+    owner_id = models.BigIntegerField()
+    photo = models.ForeignKey(
+        Photo,
+        related_name="+",
+        blank=True,
+        null=True,
+        on_delete=models.deletion.SET_NULL,
+    )
+    # Changes when another photo gets assigned
+    last_modified = models.DateTimeField(default=timezone.now)
+    objects = AvatarDigestManager()
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """
+        Class attributes
+        """
+
+        verbose_name = _("avatar digest")
+        verbose_name_plural = _("avatar digests")
+        indexes = [
+            models.Index(fields=["owner_type", "owner_id"]),
+        ]
+
+    @classmethod
+    def owner_type_of(cls, owner):
+        """
+        Return the owner type for a confirmed email / OpenID instance
+        """
+        if isinstance(owner, ConfirmedOpenId):
+            return cls.OPENID
+        return cls.EMAIL
+
+    @property
+    def owner_model(self):
+        """
+        Return the model class of the owner of this digest
+        """
+        if self.owner_type == self.OPENID:
+            return ConfirmedOpenId
+        return ConfirmedEmail
+
+    def __str__(self):
+        return "%s (%s %i)" % (self.digest, self.owner_type, self.owner_id)
+
+
+def release_photo_data(storage, digest):
+    """
+    Remove the image data from the storage, unless another photo (with the
+    very same image) still uses it
+    """
+    if not digest or storage == DatabaseStorage.name:
+        return
+    if Photo.objects.filter(  # pylint: disable=no-member
+        storage=storage, digest=digest
+    ).exists():
+        return
+    try:
+        get_storage(storage).delete(digest)
+    except Exception as exc:  # pylint: disable=broad-except
+        print("Unable to remove photo data %s from %s: %s" % (digest, storage, exc))
+
+
+@receiver(post_delete, sender=Photo)
+def release_deleted_photo_data(
+    sender, instance, **kwargs
+):  # pylint: disable=unused-argument
+    """
+    Remove the image data of deleted photos from the storage
+    """
+    release_photo_data(instance.storage, instance.digest)
+
+
+@receiver(post_delete, sender=ConfirmedEmail)
+@receiver(post_delete, sender=ConfirmedOpenId)
+def unregister_avatar_digests(
+    sender, instance, **kwargs
+):  # pylint: disable=unused-argument
+    """
+    Drop the digests of deleted email addresses / OpenIDs from the index
+    """
+    AvatarDigest.objects.unregister(instance)
+
+
 class OpenIDNonce(models.Model):
     """
     Model holding OpenID Nonces
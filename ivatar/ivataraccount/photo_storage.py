@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends for the image data of photos
+
+Photos only keep their metadata in the database, the image data is kept
+by one of these backends, addressed by its sha256 digest:
+
+- "db": in the database after all (Photo.data), as it has always been
+- "file": in a directory tree on the (shared) filesystem
+- "s3": in a bucket of an S3-compatible object store (needs boto3)
+"""
+import os
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+
+from ivatar.settings import PHOTO_STORAGE_DIR, PHOTO_STORAGE_S3
+
+try:
+    import boto3
+except ImportError:  # pragma: no cover
+    boto3 = None  # pylint: disable=invalid-name
+
+
+class DatabaseStorage:
+    """
+    Image data stays in the database; the Photo model handles that itself
+    """
+
+    name = "db"
+
+
+class FileSystemStorage:
+    """
+    Content-addressed storage in a directory tree
+    """
+
+    name = "file"
+
+    def __init__(self, location):
+        self.location = location
+
+    def _path(self, digest):
+        return os.path.join(self.location, digest[0:2], digest[2:4], digest)
+
+    def save(self, digest, data):
+        """
+        Store data under its digest; the same content is only stored once
+        """
+        filename = self._path(digest)
+        if os.path.isfile(filename):
+            return
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        (handle, tmpname) = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(handle, "wb") as blob:
+            blob.write(data)
+        os.replace(tmpname, filename)
+
+    def load(self, digest):
+        """
+        Return the data stored under digest
+        """
+        with open(self._path(digest), "rb") as blob:
+            return blob.read()
+
+    def delete(self, digest):
+        """
+        Remove the data stored under digest
+        """
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage:
+    """
+    Storage in a bucket of an S3-compatible object store
+    """
+
+    name = "s3"
+
+    def __init__(
+        self,
+        bucket,
+        prefix="",
+        endpoint_url=None,
+        access_key=None,
+        secret_key=None,
+        region=None,
+    ):  # pylint: disable=too-many-arguments
+        if boto3 is None:
+            raise ImproperlyConfigured("boto3 is required for the s3 photo storage")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            region_name=region,
+        )
+
+    def _key(self, digest):
+        return "%s%s" % (self.prefix, digest)
+
+    def save(self, digest, data):
+        """
+        Store data under its digest
+        """
+        self.client.put_object(Bucket=self.bucket, Key=self._key(digest), Body=data)
+
+    def load(self, digest):
+        """
+        Return the data stored under digest
+        """
+        obj = self.client.get_object(Bucket=self.bucket, Key=self._key(digest))
+        return obj["Body"].read()
+
+    def delete(self, digest):
+        """
+        Remove the data stored under digest
+        """
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(digest))
+
+
+_storages = {}  # pylint: disable=invalid-name
+
+
+def get_storage(name):
+    """
+    Return the (shared) storage backend of the given name
+    """
+    if name not in _storages:
+        if name == DatabaseStorage.name:
+            _storages[name] = DatabaseStorage()
+        elif name == FileSystemStorage.name:
+            _storages[name] = FileSystemStorage(PHOTO_STORAGE_DIR)
+        elif name == S3Storage.name:
+            _storages[name] = S3Storage(**PHOTO_STORAGE_S3)
+        else:
+            raise ImproperlyConfigured("Unknown photo storage: %s" % name)
+    return _storages[name]
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Test our buffered access counters in ivatar.ivataraccount.counters
+"""
+import io
+import os
+import django
+from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.contrib.auth.models import User
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "ivatar.settings"
+django.setup()
+
+# pylint: disable=wrong-import-position
+from ivatar.ivataraccount import counters
+from ivatar.ivataraccount.counters import AccessCounter, PENDING_CACHE_KEY
+from ivatar.ivataraccount.counters import _cache_key, _pending_key, _flush_at_exit
+from ivatar.ivataraccount.models import ConfirmedEmail
+from ivatar.testing import TemporaryCachesMixin
+from ivatar.utils import random_string
+
+# pylint: enable=wrong-import-position
+
+
+class Tester(TemporaryCachesMixin, TestCase):
+    """
+    Main test class
+    """
+
+    def setUp(self):
+        """
+        Prepare for tests.
+        - Create user with a confirmed mail address
+        """
+        super().setUp()
+        user = User.objects.create_user(
+            username=random_string(),
+            password=random_string(),
+        )
+        (confirmed_id, _) = ConfirmedEmail.objects.create_confirmed_email(
+            user, "%s@%s.org" % (random_string(), random_string()), False
+        )
+        self.confirmed = ConfirmedEmail.objects.get(pk=confirmed_id)
+
+    def test_process_counter(self):
+        """
+        Accesses are only written to the database when flushing
+        """
+        counter = AccessCounter(backend="process", interval=3600)
+        for _ in range(3):
+            counter.record(ConfirmedEmail, self.confirmed.pk)
+        self.confirmed.refresh_from_db()
+        self.assertEqual(self.confirmed.access_count, 0, "counted too early?")
+        self.assertEqual(counter.flush(), 3, "not all accesses flushed?")
+        self.confirmed.refresh_from_db()
+        self.assertEqual(self.confirmed.access_count, 3, "accesses got lost?")
+        self.assertEqual(counter.flush(), 0, "flushed the same accesses twice?")
+
+    def test_cache_counter(self):
+        """
+        Accesses end up in the cache and are written to the database
+        by the management command
+        """
+        counter = AccessCounter(backend="cache", interval=3600)
+        for _ in range(2):
+            counter.record(ConfirmedEmail, self.confirmed.pk)
+        counter.flush()
+        counter.record(ConfirmedEmail, self.confirmed.pk)
+        counter.flush()
+        self.confirmed.refresh_from_db()
+        self.assertEqual(self.confirmed.access_count, 0, "counted too early?")
+
+        call_command("flush_access_counts", stdout=io.StringIO())
+        self.confirmed.refresh_from_db()
+        self.assertEqual(self.confirmed.access_count, 3, "accesses got lost?")
+
+        call_command("flush_access_counts", stdout=io.StringIO())
+        self.confirmed.refresh_from_db()
+        self.assertEqual(self.confirmed.access_count, 3, "counted twice?")
+
+    def test_cache_counter_cleanup(self):
+        """
+        Counters written to the database are removed from the cache, as
+        are pending counters, which got evicted
+        """
+        counter = AccessCounter(backend="cache", interval=3600)
+        counter.record(ConfirmedEmail, self.confirmed.pk)
+        counter.record(ConfirmedEmail, -1)
+        counter.flush()
+        cache.delete(_cache_key("ivataraccount.confirmedemail", -1))
+
+        call_command("flush_access_counts", stdout=io.StringIO())
+        self.assertIsNone(
+            cache.get(_cache_key("ivataraccount.confirmedemail", self.confirmed.pk)),
+            "written counter kept?",
+        )
+        self.assertIsNone(
+            cache.get(_pending_key(cache.get(PENDING_CACHE_KEY))),
+            "pending counters kept?",
+        )
+
+    def test_cache_counter_interleaved(self):
+        """
+        Counters pushed concurrently (and flushed in between) aren't lost
+        """
+        (other_id, _) = ConfirmedEmail.objects.create_confirmed_email(
+            self.confirmed.user,
+            "%s@%s.org" % (random_string(), random_string()),
+            False,
+        )
+        first = AccessCounter(backend="cache", interval=3600)
+        first.record(ConfirmedEmail, self.confirmed.pk)
+        second = AccessCounter(backend="cache", interval=3600)
+        second.record(ConfirmedEmail, other_id)
+
+        next_pending_number = counters._next_pending_number
+
+        def interleaved():
+            # The second push and a flush get in, after the first one took
+            # its number, but before it's written its pending counters
+            counters._next_pending_number = next_pending_number
+            number = next_pending_number()
+            second.flush()
+            call_command("flush_access_counts", stdout=io.StringIO())
+            return number
+
+        counters._next_pending_number = interleaved
+        try:
+            first.flush()
+        finally:
+            counters._next_pending_number = next_pending_number
+        self.assertEqual(
+            ConfirmedEmail.objects.get(pk=other_id).access_count,
+            1,
+            "second push lost?",
+        )
+
+        call_command("flush_access_counts", stdout=io.StringIO())
+        self.confirmed.refresh_from_db()
+        self.assertEqual(self.confirmed.access_count, 1, "first push lost?")
+        call_command("flush_access_counts", stdout=io.StringIO())
+        self.assertEqual(
+            ConfirmedEmail.objects.get(pk=other_id).access_count,
+            1,
+            "counted twice?",
+        )
+
+    def test_flush_at_exit(self):
+        """
+        Accesses are only written on exit to the database they were
+        counted against
+        """
+        counter = AccessCounter(backend="process", interval=3600)
+        counter.record(ConfirmedEmail, self.confirmed.pk)
+        counter.database = "some other database"
+        _flush_at_exit(counter)
+        self.confirmed.refresh_from_db()
+        self.assertEqual(self.confirmed.access_count, 0, "written to this one?")
+
+        counter = AccessCounter(backend="process", interval=3600)
+        counter.record(ConfirmedEmail, self.confirmed.pk)
+        _flush_at_exit(counter)
+        self.confirmed.refresh_from_db()
+        self.assertEqual(self.confirmed.access_count, 1, "not written on exit?")
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Test the storage backends for photos in ivatar.ivataraccount.photo_storage
+"""
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import django
+from django.test import TestCase
+from django.core.management import call_command
+from django.contrib.auth.models import User
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "ivatar.settings"
+django.setup()
+
+# pylint: disable=wrong-import-position
+from ivatar import settings
+from ivatar.ivataraccount import models
+from ivatar.ivataraccount import photo_storage
+from ivatar.ivataraccount.models import Photo
+from ivatar.ivataraccount.photo_storage import FileSystemStorage, S3Storage
+from ivatar.utils import random_string
+
+# pylint: enable=wrong-import-position
+
+TEST_IMAGE_FILE = os.path.join(settings.STATIC_ROOT, "img", "deadbeef.png")
+
+
+class ObjectStoreStub(BaseHTTPRequestHandler):
+    """
+    Minimal S3-compatible object store (path-style, no authentication)
+    """
+
+    protocol_version = "HTTP/1.1"
+    objects = {}
+
+    def _respond(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """
+        Store an object
+        """
+        length = int(self.headers.get("Content-Length", 0))
+        self.objects[self.path.split("?")[0]] = self.rfile.read(length)
+        self._respond(200)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Return an object
+        """
+        body = self.objects.get(self.path.split("?")[0])
+        if body is None:
+            self._respond(
+                404, b"<Error><Code>NoSuchKey</Code><Message></Message></Error>"
+            )
+        else:
+            self._respond(200, body)
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        """
+        Remove an object
+        """
+        self.objects.pop(self.path.split("?")[0], None)
+        self._respond(204)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class Tester(TestCase):
+    """
+    Main test class
+    """
+
+    def setUp(self):
+        """
+        Prepare for tests.
+        - Create user, keep photos below a temporary directory
+        """
+        self.user = User.objects.create_user(
+            username=random_string(),
+            password=random_string(),
+        )
+        with open(TEST_IMAGE_FILE, "rb") as data:
+            self.image = data.read()
+        self.location = tempfile.mkdtemp()
+        self.storages = dict(photo_storage._storages)
+        photo_storage._storages["file"] = FileSystemStorage(self.location)
+
+    def tearDown(self):
+        models.PHOTO_STORAGE = settings.PHOTO_STORAGE
+        photo_storage._storages.clear()
+        photo_storage._storages.update(self.storages)
+        shutil.rmtree(self.location)
+
+    def new_photo(self):
+        """
+        Save a new photo of our user
+        """
+        photo = Photo(user=self.user, ip_address="127.0.0.1")
+        photo.data = self.image
+        photo.save()
+        return photo
+
+    def test_file_storage(self):
+        """
+        Image data ends up on the filesystem, only once per content,
+        and is removed with the last photo using it
+        """
+        models.PHOTO_STORAGE = "file"
+        photo = self.new_photo()
+        other = self.new_photo()
+        stored = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(stored.storage, "file", "not stored as file?")
+        self.assertEqual(bytes(stored.data), b"", "image still in the database?")
+        self.assertEqual(stored.get_data(), photo.get_data(), "image changed?")
+        self.assertEqual(stored.digest, other.digest, "same image, other digest?")
+        filename = photo_storage.get_storage("file")._path(photo.digest)
+        self.assertTrue(os.path.isfile(filename), "image not on the filesystem?")
+
+        photo.delete()
+        self.assertTrue(os.path.isfile(filename), "image of other photo removed?")
+        other.delete()
+        self.assertFalse(os.path.isfile(filename), "image of deleted photo kept?")
+
+    def test_migrate_photo_storage(self):
+        """
+        Existing photos are moved out of the database and back, without
+        changing them
+        """
+        photo = self.new_photo()
+        self.assertEqual(photo.storage, "db", "not stored in the database?")
+        last_modified = Photo.objects.get(pk=photo.pk).last_modified
+        image = photo.get_data()
+
+        call_command("migrate_photo_storage", "--to", "file", stdout=io.StringIO())
+        stored = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(stored.storage, "file", "not moved?")
+        self.assertEqual(bytes(stored.data), b"", "image still in the database?")
+        self.assertEqual(stored.get_data(), image, "image changed?")
+        self.assertEqual(stored.last_modified, last_modified, "photo changed?")
+
+        call_command("migrate_photo_storage", "--to", "db", stdout=io.StringIO())
+        stored = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(stored.storage, "db", "not moved back?")
+        self.assertEqual(bytes(stored.data), image, "image changed?")
+        filename = photo_storage.get_storage("file")._path(stored.digest)
+        self.assertFalse(os.path.isfile(filename), "image left behind?")
+
+    @unittest.skipIf(photo_storage.boto3 is None, "boto3 not installed")
+    def test_s3_storage(self):
+        """
+        Image data ends up in the object store
+        """
+        ObjectStoreStub.objects = {}
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ObjectStoreStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        photo_storage._storages["s3"] = S3Storage(
+            "photos",
+            endpoint_url="http://127.0.0.1:%i" % server.server_address[1],
+            access_key="test",
+            secret_key="test",
+            region="us-east-1",
+        )
+
+        models.PHOTO_STORAGE = "s3"
+        photo = self.new_photo()
+        self.assertIn(
+            "/photos/%s" % photo.digest, ObjectStoreStub.objects, "not uploaded?"
+        )
+        stored = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(stored.get_data(), photo.get_data(), "image changed?")
+        photo.delete()
+        self.assertEqual(ObjectStoreStub.objects, {}, "image of deleted photo kept?")
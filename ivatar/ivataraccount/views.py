@@ -46,7 +46,9 @@ from ivatar.settings import (
     MAX_PHOTO_SIZE,
     JPEG_QUALITY,
     AVATAR_MAX_SIZE,
+    PHOTO_RENDITION_SIZES,
 )
+from ivatar.render import RenderBusyError
 from .gravatar import get_photo as get_gravatar_photo
 
 from .forms import AddEmailForm, UploadPhotoForm, AddOpenIDForm
@@ -447,16 +449,31 @@ class ImportPhotoView(SuccessMessageMixin, TemplateView):
 @method_decorator(login_required, name="dispatch")
 class RawImageView(DetailView):
     """
-    View to return (binary) raw image data, for use in <img/>-tags
+    View to return (binary) raw image data, for use in <img/>-tags;
+    with ?size=N a thumbnail from the rendition store instead, which
+    keeps the aspect ratio of photos not cropped (yet)
     """
 
     model = Photo
 
     def get(self, request, *args, **kwargs):
         photo = self.model.objects.get(pk=kwargs["pk"])  # pylint: disable=no-member
-        if not photo.user.id == request.user.id and not request.user.is_staff:
+        if not photo.user_id == request.user.id and not request.user.is_staff:
             return HttpResponseRedirect(reverse_lazy("home"))
-        return HttpResponse(BytesIO(photo.data), content_type="image/%s" % photo.format)
+        try:
+            size = int(request.GET.get("size", 0))
+        except ValueError:
+            size = 0
+        data = None
+        if size in PHOTO_RENDITION_SIZES:
+            try:
+                data = photo.get_rendition(size, square=False)
+            except RenderBusyError:
+                # The browser scales the photo down as well
+                pass
+        if data is None:
+            data = photo.get_data()
+        return HttpResponse(BytesIO(data), content_type="image/%s" % photo.format)
 
 
 @method_decorator(login_required, name="dispatch")
@@ -1212,8 +1229,8 @@ class ExportView(SuccessMessageMixin, TemplateView):
 
         def xml_photos(user):
             s = "  <photos>\n"
-            for photo in user.photo_set.all():
-                encoded_photo = base64.b64encode(photo.data)
+            for photo in user.photo_set.with_data():
+                encoded_photo = base64.b64encode(photo.get_data())
                 if encoded_photo:
                     s += (
                         """    <photo id="%s" encoding="base64" format=%s>"""
@@ -1227,8 +1244,8 @@ class ExportView(SuccessMessageMixin, TemplateView):
         user = request.user
 
         photos = []
-        for photo in user.photo_set.all():
-            photo_details = {"data": photo.data, "format": photo.format}
+        for photo in user.photo_set.with_data():
+            photo_details = {"data": photo.get_data(), "format": photo.format}
             photos.append(photo_details)
 
         bytesobj = BytesIO()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of processes rendering images
+
+Decoding, resizing and encoding photos and generating default avatars is
+CPU bound (and mostly holds the GIL), so it's done by processes of their
+own, rather than by the threads serving requests. The number of renders
+waiting for a process is bounded: once it's reached, or a render takes
+too long, RenderBusyError tells the caller to serve something cheaper.
+
+Renders given up on are cancelled, if they're still waiting for a
+process. Those already running can't be stopped: they keep their process
+and count as pending until they're done, so renders taking too long
+leave less room for others, rather than piling up.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+
+from ivatar.settings import RENDER_WORKERS, RENDER_MAX_PENDING, RENDER_TIMEOUT
+
+
+class RenderBusyError(Exception):
+    """
+    The render was refused (too many pending) or took too long
+    """
+
+
+def _init_worker():
+    """
+    Set up Django in a new render process, as renders may use models
+    """
+    django.setup()
+
+
+class RenderPool:
+    """
+    Bounded pool of render processes, started on first use
+    """
+
+    def __init__(self, workers, max_pending, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        # Renders being done or waiting for a process
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.refused = 0
+        self.timeouts = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    # Forking copies the locks held by other threads (of a
+                    # threaded server), which then never get released
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                )
+            return self._executor
+
+    def _reset(self, executor):
+        """
+        Drop the executor once it's broken (a render process died, eg.
+        being killed for using too much memory), the next render starts
+        a new one
+        """
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def render(self, func, *args, **kwargs):
+        """
+        Return func(*args, **kwargs), called by a render process (so func
+        and the arguments must be picklable), or by the calling thread, if
+        there are no render processes
+        """
+        if not self.workers:
+            return func(*args, **kwargs)
+
+        if not self._slots.acquire(blocking=False):
+            self.refused += 1
+            raise RenderBusyError("Too many renders pending")
+        executor = self._get_executor()
+        try:
+            future = executor.submit(func, *args, **kwargs)
+        except BrokenProcessPool as exc:
+            self._slots.release()
+            self._reset(executor)
+            raise RenderBusyError("Render processes died") from exc
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is free again once the render is done (or cancelled),
+        # even if nobody waits for it any more
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError as exc:
+            self.timeouts += 1
+            # Only possible while it's waiting for a process, see above
+            future.cancel()
+            raise RenderBusyError(
+                "Render took longer than %s seconds" % self.timeout
+            ) from exc
+        except BrokenProcessPool as exc:
+            self._reset(executor)
+            raise RenderBusyError("Render process died") from exc
+
+    def shutdown(self):
+        """
+        Stop the render processes (new renders start them again)
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor:
+            executor.shutdown()
+
+
+render_pool = RenderPool(  # pylint: disable=invalid-name
+    RENDER_WORKERS, RENDER_MAX_PENDING, RENDER_TIMEOUT
+)
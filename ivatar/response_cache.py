@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Two-tier cache for avatar responses: a size-bounded in-memory LRU cache
+per process, in front of the shared "filesystem" cache
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from ivatar.settings import CACHES, CACHE_RESPONSE_MEMORY_MAX_BYTES
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache, bounded by the summed size of its values
+    """
+
+    def __init__(self, max_bytes, timeout=None):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Return the value for key or None, if it's not (or no longer) there
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size, timeout=None):
+        """
+        Store value (taking size bytes), for timeout seconds (or the
+        default timeout), and evict the least recently used entries until
+        we're within budget again
+        """
+        if size > self.max_bytes:
+            return
+        timeout = timeout or self.timeout
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Remove key from the cache
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Remove everything from the cache
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key)[1]
+
+    def stats(self):
+        """
+        Return the counters of this cache
+        """
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Entries expire with the same timeout as in the filesystem cache, so
+# both tiers return the same
+memory_cache = LRUCache(  # pylint: disable=invalid-name
+    CACHE_RESPONSE_MEMORY_MAX_BYTES,
+    CACHES["filesystem"].get("TIMEOUT", 300),
+)
+
+
+def get_cached_response(key):
+    """
+    Return the cached response entry for key, looking into the memory
+    first and into the filesystem cache second
+    """
+    entry = memory_cache.get(key)
+    if entry is None:
+        entry = caches["filesystem"].get(key)
+        if entry:
+            # Older entries might still hold file-like content
+            if hasattr(entry["content"], "getvalue"):
+                entry["content"] = entry["content"].getvalue()
+            # Not for longer than it's left in the filesystem cache (older
+            # entries don't tell, they're not promoted)
+            if "expires" in entry:
+                timeout = entry["expires"] and entry["expires"] - time.time()
+                if timeout is None or timeout > 0:
+                    memory_cache.set(key, entry, len(entry["content"]), timeout)
+    return entry
+
+
+def set_cached_response(key, entry):
+    """
+    Store the response entry in both tiers, along with the time it expires
+    """
+    timeout = caches["filesystem"].default_timeout
+    entry["expires"] = None if timeout is None else time.time() + timeout
+    memory_cache.set(key, entry, len(entry["content"]), timeout)
+    caches["filesystem"].set(key, entry, timeout)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for ASGI
+"""
+import unittest
+
+import os
+import django
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "ivatar.settings"
+django.setup()
+
+
+class TestCase(unittest.TestCase):
+    """
+    Simple testcase to see if ASGI loads correctly
+    """
+
+    def test_run_asgi(self):
+        """
+        Run asgi import
+        """
+        import ivatar.asgi  # pylint: disable=import-outside-toplevel
+
+        self.assertEqual(
+            ivatar.asgi.application.__class__, django.core.handlers.asgi.ASGIHandler
+        )
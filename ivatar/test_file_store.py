@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Test our persistent store in ivatar.file_store
+"""
+import os
+import shutil
+import tempfile
+import time
+import django
+from django.test import TestCase
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "ivatar.settings"
+django.setup()
+
+# pylint: disable=wrong-import-position
+from ivatar.file_store import FileStore
+
+# pylint: enable=wrong-import-position
+
+
+class Tester(TestCase):
+    """
+    Main test class
+    """
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+
+    def test_get_set(self):
+        """
+        Stored data is returned, also from another instance (process)
+        """
+        store = FileStore(self.location, 1024)
+        self.assertIsNone(store.get("a"), "empty store returns data?")
+        store.set("a", b"aaaa")
+        self.assertEqual(store.get("a"), b"aaaa", "stored data missing?")
+        other = FileStore(self.location, 1024)
+        self.assertEqual(other.get("a"), b"aaaa", "store not shared?")
+        store.delete("a")
+        self.assertIsNone(other.get("a"), "deleted data still returned")
+
+    def test_eviction(self):
+        """
+        Once over budget, the least recently used entries are evicted
+        """
+        store = FileStore(self.location, 100)
+        for (age, key) in enumerate("abcde"):
+            store.set(key, b"x" * 30)
+            # Make the modification times distinct, "a" being the oldest
+            mtime = 1000000000 + age
+            path = store._path(key)  # pylint: disable=protected-access
+            os.utime(path, (mtime, mtime))
+        store.cull()
+        self.assertIsNone(store.get("a"), "oldest entry not evicted")
+        self.assertIsNone(store.get("b"), "old entry not evicted")
+        self.assertEqual(store.get("e"), b"x" * 30, "newest entry evicted")
+
+    def test_background_cull(self):
+        """
+        Writing over budget has entries evicted in the background, but the
+        store isn't walked again right after that
+        """
+        store = FileStore(self.location, 100)
+        store.set("a", b"x" * 150)
+        for _ in range(100):
+            if store.get("a") is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(store.get("a"), "store over budget not culled")
+        store.set("b", b"x" * 150)
+        time.sleep(0.1)
+        self.assertEqual(store.get("b"), b"x" * 150, "store culled again right away")
+
+    def test_disabled(self):
+        """
+        Without budget, nothing is stored
+        """
+        store = FileStore(self.location, 0)
+        store.set("a", b"aaaa")
+        self.assertIsNone(store.get("a"), "disabled store returns data?")
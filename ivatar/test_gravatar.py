@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+"""
+Test our Gravatar client and proxy against a local stub of Gravatar
+"""
+import asyncio
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+import django
+import httpx
+from django.test import TestCase
+from django.test import Client
+from django.core.cache import cache
+from django.contrib.staticfiles import finders
+from PIL import Image
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "ivatar.settings"
+django.setup()
+
+# pylint: disable=wrong-import-position
+from ivatar.gravatar import GravatarClient, gravatar_client
+from ivatar.gravatar import gravatar_images, refresh_image
+from ivatar.gravatar import gravatar_image_sync, gravatar_loop, close
+from ivatar.circuit_breaker import CircuitBreaker, CircuitOpenError
+from ivatar.testing import TemporaryCachesMixin
+from ivatar.utils import random_string
+from ivatar.views import avatar_cache_key
+from ivatar.response_cache import get_cached_response
+from ivatar.settings import CACHE_IMAGES_MAX_AGE
+
+# pylint: enable=wrong-import-position
+
+EXISTING_DIGEST = "%032x" % 0xC0FFEE
+
+
+class GravatarStub(BaseHTTPRequestHandler):
+    """
+    Stands in for secure.gravatar.com: knows one avatar, answers 404 for
+    all others, if asked to (d=404); delays and failures can be injected
+    """
+
+    protocol_version = "HTTP/1.1"
+    delay = 0
+    fail = None
+    requests = []
+    connections = set()
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Answer like Gravatar would
+        """
+        url = urlsplit(self.path)
+        args = parse_qs(url.query)
+        self.requests.append(self.path)
+        self.connections.add(self.client_address)
+        time.sleep(self.delay)
+        if self.fail:
+            self.send_response(self.fail)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if not url.path.endswith(EXISTING_DIGEST) and args.get("d") == ["404"]:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        size = int(args.get("s", ["80"])[0])
+        data = BytesIO()
+        Image.new("RGB", (size, size), "red").save(data, "PNG")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data.getvalue())))
+        self.end_headers()
+        try:
+            self.wfile.write(data.getvalue())
+        except BrokenPipeError:
+            # Client timed out
+            pass
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class Tester(TemporaryCachesMixin, TestCase):
+    """
+    Main test class
+    """
+
+    client = Client()
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), GravatarStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = "http://127.0.0.1:%i/avatar/" % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        # Drop the connections to the stub
+        close()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        GravatarStub.delay = 0
+        GravatarStub.fail = None
+        GravatarStub.requests.clear()
+        GravatarStub.connections.clear()
+        self.saved_base_url = gravatar_client.base_url
+        gravatar_client.base_url = self.base_url
+        asyncio.run(gravatar_client.breaker.reset())
+
+    def tearDown(self):
+        gravatar_client.base_url = self.saved_base_url
+        super().tearDown()
+
+    def test_coalescing(self):
+        """
+        Concurrent fetches of the same URL share one upstream request
+        """
+        client = GravatarClient(self.base_url, 5, 10)
+        url = client.url(EXISTING_DIGEST, 80)
+        GravatarStub.delay = 0.2
+
+        async def fetch_all():
+            results = await asyncio.gather(*[client.fetch(url) for _ in range(5)])
+            await client.aclose()
+            return results
+
+        results = asyncio.run(fetch_all())
+        self.assertEqual(len(GravatarStub.requests), 1, "fetches not coalesced?")
+        for (status, content) in results:
+            self.assertEqual(status, 200, "fetch failed?")
+            self.assertTrue(content, "no content?")
+
+    def test_connection_reuse(self):
+        """
+        Sequential fetches reuse the keep-alive connection
+        """
+        client = GravatarClient(self.base_url, 5, 10)
+
+        async def fetch_sizes():
+            for size in (16, 32, 64):
+                await client.fetch(client.url(EXISTING_DIGEST, size))
+            await client.aclose()
+
+        asyncio.run(fetch_sizes())
+        self.assertEqual(len(GravatarStub.requests), 3, "fetch missing?")
+        self.assertEqual(len(GravatarStub.connections), 1, "connection not reused?")
+
+    def test_sync_shared_loop(self):
+        """
+        Synchronous callers share one event loop, and its connections
+        """
+        for size in (17, 33):
+            image = gravatar_image_sync(EXISTING_DIGEST, size)
+            self.assertEqual(
+                Image.open(BytesIO(image[0])).size, (size, size), "wrong image?"
+            )
+            gravatar_images.delete(gravatar_client.url(EXISTING_DIGEST, size, 404))
+        self.assertTrue(gravatar_loop.running, "no shared loop?")
+        self.assertEqual(len(GravatarStub.connections), 1, "connection not reused?")
+
+    def test_proxy_shared_loop(self):
+        """
+        The (asynchronous) proxy view fetches in the shared event loop, so
+        its requests reuse the connections, whichever loop runs the view
+        """
+        for size in (18, 34):
+            response = self.client.get(
+                "/gravatarproxy/%s?s=%i" % (EXISTING_DIGEST, size)
+            )
+            self.assertEqual(response.status_code, 200, "unable to proxy avatar?")
+            gravatar_images.delete(gravatar_client.url(EXISTING_DIGEST, size, 404))
+        self.assertEqual(len(GravatarStub.requests), 2, "fetch missing?")
+        self.assertEqual(len(GravatarStub.connections), 1, "connection not reused?")
+
+    def test_unreachable(self):
+        """
+        Connection errors are raised as httpx.HTTPError
+        """
+        client = GravatarClient("http://127.0.0.1:1/avatar/", 1, 1)
+
+        async def fetch():
+            try:
+                return await client.fetch(client.url(EXISTING_DIGEST, 80))
+            finally:
+                await client.aclose()
+
+        with self.assertRaises(httpx.HTTPError):
+            asyncio.run(fetch())
+
+    def test_proxy_existing(self):
+        """
+        Existing Gravatar images are served by the proxy
+        """
+        response = self.client.get("/gravatarproxy/%s?s=64" % EXISTING_DIGEST)
+        self.assertEqual(response.status_code, 200, "unable to proxy avatar?")
+        self.assertEqual(response["Content-Type"], "image/png", "wrong type?")
+        self.assertEqual(
+            Image.open(BytesIO(response.content)).size, (64, 64), "wrong size?"
+        )
+
+    def test_proxy_inexisting(self):
+        """
+        Without Gravatar image, the proxy redirects to our default
+        """
+        digest = random_string(32).lower()
+        response = self.client.get("/gravatarproxy/%s?s=80" % digest)
+        self.assertEqual(response.status_code, 302, "no redirect?")
+        self.assertEqual(
+            response["Location"],
+            "/avatar/%s?s=80&forcedefault=y" % digest,
+            "Doesn't redirect with default forced on?",
+        )
+        self.assertTrue(
+            cache.get("gravatar_missing:%s" % digest), "negative result not cached?"
+        )
+        # Gravatar doesn't have an image at any other size either
+        response = self.client.get("/gravatarproxy/%s?s=120" % digest)
+        self.assertEqual(response.status_code, 302, "no redirect?")
+        self.assertEqual(
+            len(GravatarStub.requests), 1, "asked again for inexisting image?"
+        )
+
+    def test_proxy_single_request(self):
+        """
+        One upstream request tells if Gravatar has an image and returns it,
+        and that image is cached
+        """
+        for _ in range(2):
+            response = self.client.get("/gravatarproxy/%s?s=48" % EXISTING_DIGEST)
+            self.assertEqual(response.status_code, 200, "unable to proxy avatar?")
+        self.assertEqual(
+            GravatarStub.requests,
+            ["/avatar/%s?s=48&d=404" % EXISTING_DIGEST],
+            "more than one request to Gravatar?",
+        )
+
+    def test_stale_while_revalidate(self):
+        """
+        Outdated images are served right away and refreshed in the background
+        """
+        url = gravatar_client.url(EXISTING_DIGEST, 40, 404)
+        gravatar_images.set(
+            url,
+            b"stale",
+            "image/png",
+            fetched=time.time() - gravatar_images.max_age / 2,
+        )
+        response = self.client.get("/gravatarproxy/%s?s=40" % EXISTING_DIGEST)
+        self.assertEqual(response.content, b"stale", "stored image not served?")
+
+        # Another refresh isn't started, while one is running
+        self.assertIsNone(gravatar_loop.run(refresh_image(url)), "refreshing twice?")
+        for _ in range(50):
+            (content, _, age) = gravatar_images.get(url)
+            if content != b"stale":
+                break
+            time.sleep(0.1)
+        self.assertEqual(
+            Image.open(BytesIO(content)).size, (40, 40), "image not refreshed?"
+        )
+        self.assertLess(age, 60, "refreshed image is old?")
+        self.assertEqual(len(GravatarStub.requests), 1, "refreshed more than once?")
+        gravatar_images.delete(url)
+
+    def test_stale_if_error(self):
+        """
+        Expired images are served, if Gravatar fails
+        """
+        gravatar_client.base_url = "http://127.0.0.1:1/avatar/"
+        url = gravatar_client.url(EXISTING_DIGEST, 40, 404)
+        gravatar_images.set(url, b"expired", "image/png", fetched=1)
+        response = self.client.get("/gravatarproxy/%s?s=40" % EXISTING_DIGEST)
+        self.assertEqual(response.status_code, 200, "expired image not served?")
+        self.assertEqual(response.content, b"expired", "expired image not served?")
+        self.assertEqual(cache.get(url), "err", "error not cached?")
+        gravatar_images.delete(url)
+        cache.delete(url)
+
+    def test_unavailable_not_cached(self):
+        """
+        While Gravatar is unavailable, our default is served, but not cached
+        by anyone, so Gravatar's image is served again, once it's back
+        """
+        url = "/avatar/%s?s=41&d=mm" % EXISTING_DIGEST
+        cache_key = avatar_cache_key(EXISTING_DIGEST, 41, "mm")
+
+        gravatar_client.base_url = "http://127.0.0.1:1/avatar/"
+        response = self.client.get(url, follow=True)
+        self.assertEqual(
+            [location for (location, _) in response.redirect_chain],
+            [
+                "/gravatarproxy/%s?s=41&default=mm" % EXISTING_DIGEST,
+                "/avatar/%s?s=41&forcedefault=y&default=mm" % EXISTING_DIGEST,
+            ],
+            "not redirected to the proxy and back to the default?",
+        )
+        self.assertEqual(response.status_code, 200, "default not served?")
+        self.assertIsNone(get_cached_response(cache_key), "default cached?")
+        response = self.client.get("/gravatarproxy/%s?s=41" % EXISTING_DIGEST)
+        self.assertEqual(response.status_code, 302, "no redirect?")
+        self.assertEqual(response["Cache-Control"], "no-store", "redirect cached?")
+
+        gravatar_client.base_url = self.base_url
+        response = self.client.get(url, follow=True)
+        self.assertEqual(
+            GravatarStub.requests,
+            ["/avatar/%s?s=41&d=404" % EXISTING_DIGEST],
+            "Gravatar not asked again?",
+        )
+        self.assertEqual(
+            Image.open(BytesIO(response.content)).size, (41, 41), "wrong image?"
+        )
+        self.assertEqual(response["Cache-Control"], "max-age=%i" % CACHE_IMAGES_MAX_AGE)
+        gravatar_images.delete(gravatar_client.url(EXISTING_DIGEST, 41, 404))
+
+    def test_circuit_breaker(self):
+        """
+        Too many failures trip the breaker, a successful probe closes it
+        """
+        breaker = CircuitBreaker(random_string(), 3, 30, 1)
+        client = GravatarClient(self.base_url, 5, 10, breaker=breaker)
+        url = client.url(EXISTING_DIGEST, 80)
+        GravatarStub.fail = 503
+
+        async def fetch():
+            try:
+                return await client.fetch(url)
+            finally:
+                await client.aclose()
+
+        for _ in range(3):
+            self.assertEqual(asyncio.run(fetch())[0], 503, "failure not injected?")
+        self.assertEqual(asyncio.run(breaker.state()), "open", "breaker not open?")
+        with self.assertRaises(CircuitOpenError):
+            asyncio.run(fetch())
+        self.assertEqual(len(GravatarStub.requests), 3, "open breaker let through?")
+
+        # Another worker sees the same state
+        other = CircuitBreaker(breaker.name, 3, 30, 1)
+        self.assertFalse(asyncio.run(other.allow()), "state not shared?")
+
+        GravatarStub.fail = None
+        time.sleep(1.1)
+        self.assertEqual(
+            asyncio.run(breaker.state()), "half-open", "breaker not half-open?"
+        )
+        self.assertEqual(asyncio.run(fetch())[0], 200, "probe not let through?")
+        self.assertEqual(asyncio.run(breaker.state()), "closed", "breaker not closed?")
+
+    def test_circuit_breaker_failed_probe(self):
+        """
+        A failed probe trips the breaker again, only one probe is let through
+        """
+        breaker = CircuitBreaker(random_string(), 1, 30, 1)
+        client = GravatarClient("http://127.0.0.1:1/avatar/", 1, 1, breaker=breaker)
+        url = client.url(EXISTING_DIGEST, 80)
+
+        async def fetch():
+            try:
+                return await client.fetch(url)
+            finally:
+                await client.aclose()
+
+        with self.assertRaises(httpx.HTTPError):
+            asyncio.run(fetch())
+        self.assertEqual(asyncio.run(breaker.state()), "open", "breaker not open?")
+        time.sleep(1.1)
+        self.assertTrue(asyncio.run(breaker.allow()), "probe not allowed?")
+        self.assertFalse(asyncio.run(breaker.allow()), "second probe allowed?")
+        asyncio.run(breaker.record_failure())
+        self.assertEqual(asyncio.run(breaker.state()), "open", "breaker not open?")
+
+    def test_adaptive_timeout(self):
+        """
+        Timeouts adapt to the latency of Gravatar
+        """
+        breaker = CircuitBreaker(random_string(), 100, 30, 30)
+        client = GravatarClient(self.base_url, 5, 10, min_timeout=0.2, breaker=breaker)
+
+        async def fetch(count):
+            try:
+                for size in range(count):
+                    await client.fetch(client.url(EXISTING_DIGEST, size + 1))
+            finally:
+                await client.aclose()
+
+        self.assertEqual(client.current_timeout(), 5, "timeout without samples?")
+        asyncio.run(fetch(20))
+        self.assertLess(client.current_timeout(), 1, "timeout didn't adapt?")
+
+        GravatarStub.delay = 1.5
+        with self.assertRaises(httpx.TimeoutException):
+            asyncio.run(fetch(1))
+        self.assertEqual(
+            asyncio.run(cache.aget("circuit_breaker:%s:failures" % breaker.name)),
+            1,
+            "timeout not counted as failure?",
+        )
+
+    def test_slow_upstream(self):
+        """
+        Slow fetches count as failures
+        """
+        breaker = CircuitBreaker(random_string(), 1, 30, 30)
+        client = GravatarClient(self.base_url, 5, 10, breaker=breaker, slow=0.1)
+        GravatarStub.delay = 0.3
+
+        async def fetch():
+            try:
+                return await client.fetch(client.url(EXISTING_DIGEST, 80))
+            finally:
+                await client.aclose()
+
+        self.assertEqual(asyncio.run(fetch())[0], 200, "unable to fetch?")
+        self.assertEqual(asyncio.run(breaker.state()), "open", "breaker not open?")
+
+    def test_proxy_breaker_open(self):
+        """
+        With the breaker open, the proxy doesn't wait for Gravatar, nor does
+        it remember the failure beyond the breaker closing again
+        """
+        asyncio.run(gravatar_client.breaker.trip())
+        digest = random_string(32).lower()
+        response = self.client.get("/gravatarproxy/%s?s=80" % digest)
+        self.assertEqual(response.status_code, 302, "no redirect?")
+        self.assertEqual(len(GravatarStub.requests), 0, "open breaker let through?")
+        url = gravatar_client.url(digest, 80, 404)
+        self.assertIsNone(cache.get(url), "error cached?")
+
+    def test_avatar_stored(self):
+        """
+        The avatar view leaves asking Gravatar to the proxy, but serves
+        Gravatar's image itself, once it's stored
+        """
+        response = self.client.get("/avatar/%s?s=56" % EXISTING_DIGEST)
+        self.assertEqual(response.status_code, 302, "no redirect to the proxy?")
+        self.assertEqual(
+            response["Location"], "/gravatarproxy/%s?s=56" % EXISTING_DIGEST
+        )
+        self.client.get(response["Location"])
+
+        response = self.client.get("/avatar/%s?s=56&foo=bar" % EXISTING_DIGEST)
+        self.assertEqual(response.status_code, 200, "stored image not served?")
+        self.assertEqual(
+            Image.open(BytesIO(response.content)).size, (56, 56), "wrong size?"
+        )
+        self.assertEqual(len(GravatarStub.requests), 1, "Gravatar asked twice?")
+        gravatar_images.delete(gravatar_client.url(EXISTING_DIGEST, 56, 404))
+
+    def test_avatar_missing_default(self):
+        """
+        Once Gravatar is known to have no image, the avatar view serves our
+        default right away, at any size
+        """
+        digest = random_string(32).lower()
+        response = self.client.get("/avatar/%s?s=80&d=mm" % digest, follow=True)
+        self.assertEqual(len(response.redirect_chain), 2, "not via the proxy?")
+        response = self.client.get("/avatar/%s?s=120&d=mm" % digest)
+        self.assertEqual(response.status_code, 200, "redirect to the proxy?")
+        with open(finders.find("img/mm/120.png"), "rb") as image:
+            self.assertEqual(response.content, image.read(), "not our mm default?")
+        self.assertEqual(len(GravatarStub.requests), 1, "Gravatar asked twice?")
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Test our pool of render processes in ivatar.render
+"""
+import importlib.util
+import os
+import threading
+import time
+from io import BytesIO
+
+import django
+from django.test import TestCase
+from PIL import Image
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "ivatar.settings"
+django.setup()
+
+# pylint: disable=wrong-import-position
+from ivatar.render import RenderBusyError, RenderPool
+from ivatar.utils import resize_image
+
+# pylint: enable=wrong-import-position
+
+
+class Tester(TestCase):
+    """
+    Main test class
+    """
+
+    def test_inline(self):
+        """
+        Without render processes, renders are done right away
+        """
+        pool = RenderPool(0, 0, 1)
+        self.assertEqual(pool.render(os.getpid), os.getpid(), "not rendered inline?")
+
+    def test_render(self):
+        """
+        Renders are done by another process, returning the result
+        """
+        pool = RenderPool(1, 1, 60)
+        try:
+            self.assertNotEqual(pool.render(os.getpid), os.getpid(), "not offloaded?")
+            data = BytesIO()
+            Image.new("RGB", (100, 100), "red").save(data, "PNG")
+            img = Image.open(
+                BytesIO(pool.render(resize_image, data.getvalue(), 20, "PNG"))
+            )
+            self.assertEqual(img.size, (20, 20), "not resized?")
+            with self.assertRaises(ValueError):
+                pool.render(int, "x")
+        finally:
+            pool.shutdown()
+
+    def test_render_avif(self):
+        """
+        Render processes can encode AVIF, just as the serving ones
+        """
+        if importlib.util.find_spec("pillow_avif") is None:
+            self.skipTest("pillow-avif-plugin not installed")
+        pool = RenderPool(1, 1, 60)
+        try:
+            data = BytesIO()
+            Image.new("RGB", (100, 100), "red").save(data, "PNG")
+            img = Image.open(
+                BytesIO(pool.render(resize_image, data.getvalue(), 20, "AVIF"))
+            )
+            self.assertEqual((img.format, img.size), ("AVIF", (20, 20)), "no AVIF?")
+        finally:
+            pool.shutdown()
+
+    def test_busy(self):
+        """
+        Once too many renders are pending, further ones are refused
+        """
+        pool = RenderPool(1, 0, 60)
+        try:
+            # Start the render process first
+            pool.render(os.getpid)
+            slow = threading.Thread(target=pool.render, args=(time.sleep, 1))
+            slow.start()
+            time.sleep(0.2)
+            with self.assertRaises(RenderBusyError):
+                pool.render(os.getpid)
+            self.assertEqual(pool.refused, 1, "refusal not counted?")
+            slow.join()
+            self.assertNotEqual(pool.render(os.getpid), os.getpid(), "still busy?")
+        finally:
+            pool.shutdown()
+
+    def test_timeout(self):
+        """
+        Renders taking too long are given up on
+        """
+        pool = RenderPool(1, 1, 60)
+        try:
+            pool.render(os.getpid)
+            pool.timeout = 0.2
+            with self.assertRaises(RenderBusyError):
+                pool.render(time.sleep, 1)
+            self.assertEqual(pool.timeouts, 1, "timeout not counted?")
+        finally:
+            pool.shutdown()
+
+    def test_timeout_pending(self):
+        """
+        Renders given up on keep counting as pending, until they're done
+        """
+        pool = RenderPool(1, 0, 60)
+        try:
+            pool.render(os.getpid)
+            pool.timeout = 0.2
+            with self.assertRaises(RenderBusyError):
+                pool.render(time.sleep, 1)
+            with self.assertRaises(RenderBusyError):
+                pool.render(os.getpid)
+            self.assertEqual(pool.refused, 1, "not refused while still running?")
+            time.sleep(1)
+            self.assertNotEqual(pool.render(os.getpid), os.getpid(), "still busy?")
+        finally:
+            pool.shutdown()
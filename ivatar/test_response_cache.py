@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Test our response cache in ivatar.response_cache
+"""
+import os
+import time
+import django
+from django.test import TestCase
+from django.core.cache import caches
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "ivatar.settings"
+django.setup()
+
+# pylint: disable=wrong-import-position
+from ivatar.response_cache import LRUCache, memory_cache
+from ivatar.response_cache import get_cached_response, set_cached_response
+from ivatar.utils import random_string
+
+# pylint: enable=wrong-import-position
+
+
+class Tester(TestCase):
+    """
+    Main test class
+    """
+
+    def test_lru_eviction(self):
+        """
+        Least recently used entries are evicted once over budget
+        """
+        lru = LRUCache(10)
+        lru.set("a", b"aaaa", 4)
+        lru.set("b", b"bbbb", 4)
+        self.assertEqual(lru.get("a"), b"aaaa", "entry missing?")
+        lru.set("c", b"cccc", 4)
+        self.assertIsNone(lru.get("b"), "least recently used entry not evicted")
+        self.assertEqual(lru.get("a"), b"aaaa", "recently used entry evicted")
+        self.assertEqual(lru.get("c"), b"cccc", "new entry missing?")
+        stats = lru.stats()
+        self.assertEqual(stats["bytes"], 8, "size accounting is off")
+        self.assertEqual(stats["evictions"], 1, "eviction not counted")
+        self.assertEqual(stats["hits"], 3, "hits not counted")
+        self.assertEqual(stats["misses"], 1, "misses not counted")
+
+        lru.set("d", b"x" * 11, 11)
+        self.assertIsNone(lru.get("d"), "entries over budget must be skipped")
+
+    def test_lru_timeout(self):
+        """
+        Expired entries are not returned
+        """
+        lru = LRUCache(10, timeout=-1)
+        lru.set("a", b"aaaa", 4)
+        self.assertIsNone(lru.get("a"), "expired entry returned")
+        self.assertEqual(lru.stats()["bytes"], 0, "expired entry not removed")
+
+    def test_tiers(self):
+        """
+        Entries from the filesystem cache are promoted to the memory
+        """
+        key = random_string()
+        entry = {
+            "content": b"data",
+            "content_type": "image/png",
+            "status": 200,
+            "reason": None,
+            "charset": None,
+        }
+        set_cached_response(key, entry)
+        memory_cache.delete(key)
+        self.assertEqual(get_cached_response(key), entry, "filesystem tier miss")
+        caches["filesystem"].delete(key)
+        self.assertEqual(get_cached_response(key), entry, "memory tier miss")
+
+    def test_promotion_timeout(self):
+        """
+        Entries promoted to the memory expire with those in the filesystem
+        cache, instead of being kept for another full timeout
+        """
+        key = random_string()
+        entry = {
+            "content": b"data",
+            "content_type": "image/png",
+            "status": 200,
+            "reason": None,
+            "charset": None,
+            "expires": time.time() + 0.2,
+        }
+        caches["filesystem"].set(key, entry)
+        self.assertEqual(get_cached_response(key), entry, "filesystem tier miss")
+        time.sleep(0.3)
+        caches["filesystem"].delete(key)
+        self.assertIsNone(get_cached_response(key), "promoted entry outlived")
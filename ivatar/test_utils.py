@@ -3,9 +3,88 @@
 Test our utils from ivatar.utils
 """
 
+import hashlib
+from io import BytesIO
+
 from django.test import TestCase
+from PIL import Image, ImageChops, ImageDraw, ImageSequence, ImageStat
+
+from ivatar.utils import is_trusted_url, openid_variations, mm_ng
+from ivatar.utils import normalize_image, resize_animated_gif, resize_image
+
+
+def reference_mm_ng(
+    idhash, size=80, add_red=0, add_green=0, add_blue=0
+):  # pylint: disable=too-many-locals
+    """
+    The former mm_ng() implementation, drawing everything on every call
+    """
+
+    # Make sure the lightest bg color we paint is e0, else
+    # we do not see the MM any more
+    if idhash[0] == "f":
+        idhash = "e0"
+
+    # How large is the circle?
+    circlesize = size * 0.6
+
+    # Coordinates for the circle
+    start_x = int(size * 0.2)
+    end_x = start_x + circlesize
+    start_y = int(size * 0.05)
+    end_y = start_y + circlesize
+
+    # All are the same, based on the input hash
+    # this should always result in a "gray-ish" background
+    red = idhash[0:2]
+    green = idhash[0:2]
+    blue = idhash[0:2]
+
+    # Add some red (i/a) and make sure it's not over 255
+    red = hex(int(red, 16) + add_red).replace("0x", "")
+    if int(red, 16) > 255:
+        red = "ff"
+    if len(red) == 1:
+        red = "0%s" % red
 
-from ivatar.utils import is_trusted_url, openid_variations
+    # Add some green (i/a) and make sure it's not over 255
+    green = hex(int(green, 16) + add_green).replace("0x", "")
+    if int(green, 16) > 255:
+        green = "ff"
+    if len(green) == 1:
+        green = "0%s" % green
+
+    # Add some blue (i/a) and make sure it's not over 255
+    blue = hex(int(blue, 16) + add_blue).replace("0x", "")
+    if int(blue, 16) > 255:
+        blue = "ff"
+    if len(blue) == 1:
+        blue = "0%s" % blue
+
+    # Assemable the bg color "string" in webnotation. Eg. '#d3d3d3'
+    bg_color = "#" + red + green + blue
+
+    # Image
+    image = Image.new("RGB", (size, size))
+    draw = ImageDraw.Draw(image)
+
+    # Draw background
+    draw.rectangle(((0, 0), (size, size)), fill=bg_color)
+
+    # Draw MMs head
+    draw.ellipse((start_x, start_y, end_x, end_y), fill="white")
+
+    # Draw MMs 'body'
+    draw.polygon(
+        (
+            (start_x + circlesize / 2, size / 2.5),
+            (size * 0.15, size),
+            (size - size * 0.15, size),
+        ),
+        fill="white",
+    )
+
+    return image
 
 
 class Tester(TestCase):
@@ -115,3 +194,216 @@ class Tester(TestCase):
             }
         ])
         self.assertFalse(test_url_prefix_false)
+
+    def test_mm_ng(self):
+        """
+        Test if mm_ng (compositing the cached silhouette) renders exactly
+        what drawing it all did
+        """
+        for i in range(64):
+            idhash = hashlib.md5(b"%i" % i).hexdigest()
+            for size in (1, 16, 33, 80, 128, 512):
+                for add in ({}, {"add_red": 40}, {"add_green": 250, "add_blue": 9}):
+                    self.assertIsNone(
+                        ImageChops.difference(
+                            mm_ng(idhash, size, **add),
+                            reference_mm_ng(idhash, size, **add),
+                        ).getbbox(),
+                        "mm_ng(%s, %i, %s) differs" % (idhash, size, add),
+                    )
+        # Always lightest background
+        self.assertEqual(
+            mm_ng("f" * 32, 80).getpixel((0, 0)),
+            reference_mm_ng("f" * 32, 80).getpixel((0, 0)),
+        )
+
+    def test_resize_jpeg_drafted(self):
+        """
+        Test scaling down JPEGs decoded at a reduced scale: the result must
+        hardly differ from resampling the fully decoded image
+        """
+        img = Image.merge(
+            "RGB",
+            (
+                Image.effect_mandelbrot((1024, 1024), (-2, -1.5, 1, 1.5), 100),
+                Image.linear_gradient("L").resize((1024, 1024)),
+                Image.radial_gradient("L").resize((1024, 1024)),
+            ),
+        )
+        data = BytesIO()
+        img.save(data, "JPEG", quality=90)
+        for size in (80, 128, 512):
+            drafted = Image.open(BytesIO(resize_image(data.getvalue(), size, "PNG")))
+            full = Image.open(
+                BytesIO(
+                    resize_image(
+                        data.getvalue(), size, "PNG", reducing_gap=None, draft_gap=None
+                    )
+                )
+            )
+            self.assertEqual(drafted.size, (size, size), "Not resized?")
+            for rms in ImageStat.Stat(ImageChops.difference(drafted, full)).rms:
+                self.assertLess(rms, 3, "Drafted %ipx differs too much?" % size)
+
+    def test_resize_animated_gif(self):
+        """
+        Test resizing a (long) animated GIF: it must stay within the frame
+        budget and keep its timing, palette and transparency
+        """
+        palette = [0, 0, 0] + [(i * 37) % 256 for i in range(765)]
+        frames = []
+        for i in range(150):
+            frame = Image.new("P", (256, 256), 0)
+            frame.putpalette(palette)
+            ImageDraw.Draw(frame).ellipse((i, 20, i + 100, 120), fill=1 + i % 200)
+            frames.append(frame)
+        data = BytesIO()
+        frames[0].save(
+            data,
+            "GIF",
+            save_all=True,
+            append_images=frames[1:],
+            duration=[20 + 10 * (i % 3) for i in range(150)],
+            loop=0,
+            transparency=0,
+        )
+
+        resized = Image.open(BytesIO(resize_image(data.getvalue(), 64, "GIF")))
+        self.assertEqual(resized.size, (64, 64), "Not resized?")
+        self.assertLessEqual(resized.n_frames, 100, "Not decimated to 100 frames max?")
+        self.assertEqual(resized.n_frames, 75, "Not every second frame kept?")
+        self.assertEqual(
+            sum(frame.info["duration"] for frame in ImageSequence.Iterator(resized)),
+            sum(20 + 10 * (i % 3) for i in range(150)),
+            "Animation doesn't take as long as it did?",
+        )
+        self.assertEqual(resized.info["loop"], 0, "Not looping any more?")
+        colors = set(zip(palette[3:603:3], palette[4:603:3], palette[5:603:3]))
+        for frame in ImageSequence.Iterator(resized):
+            frame = frame.convert("RGBA")
+            self.assertEqual(frame.getpixel((0, 0))[3], 0, "Not transparent?")
+            self.assertLessEqual(
+                {color[:3] for (_, color) in frame.getcolors() if color[3]},
+                colors,
+                "Colours not taken from the palette?",
+            )
+        resized.seek(0)
+        self.assertEqual(
+            resized.convert("RGB").getpixel((12, 17)),
+            tuple(palette[3:6]),
+            "First frame not drawn?",
+        )
+
+        # 16 frames of 32x32 pixels at most
+        data.seek(0)
+        resized = resize_animated_gif(
+            Image.open(data), (32, 32), max_pixels=16 * 32 * 32
+        )
+        self.assertEqual(
+            Image.open(resized).n_frames, 15, "Not decimated to the pixel budget?"
+        )
+
+    def test_resize_animated_gif_many_colors(self):
+        """
+        Test resizing an animated GIF with frames of more colours than a
+        palette can hold next to the transparent one: it must stay
+        transparent
+        """
+        frames = []
+        for i in range(2):
+            frame = Image.new("P", (64, 64), 0)
+            frame.putpalette(
+                [value for j in range(256) for value in (j, 255 - j, (j * 7 + i) % 256)]
+            )
+            # Upper half transparent, lower half 255 colours
+            frame.putdata([0] * 2048 + [1 + j % 255 for j in range(2048)])
+            frames.append(frame)
+        data = BytesIO()
+        frames[0].save(
+            data, "GIF", save_all=True, append_images=frames[1:], transparency=0
+        )
+
+        resized = Image.open(BytesIO(resize_image(data.getvalue(), 32, "GIF")))
+        for frame in ImageSequence.Iterator(resized):
+            frame = frame.convert("RGBA")
+            self.assertEqual(frame.getpixel((0, 0))[3], 0, "Not transparent?")
+            self.assertEqual(frame.getpixel((0, 31))[3], 255, "Transparent?")
+
+    def test_normalize_palette_image(self):
+        """
+        Test scaling down palette images: fine detail must be blended, not
+        picked from every so many pixels, and transparency kept
+        """
+        img = Image.new("P", (400, 400), 2)
+        img.putpalette([0, 0, 0, 255, 255, 255, 0, 0, 255])
+        # Stripes of one pixel, black and white, below a transparent band
+        for x in range(0, 400, 2):
+            ImageDraw.Draw(img).line((x, 100, x, 400), fill=1)
+            ImageDraw.Draw(img).line((x + 1, 100, x + 1, 400), fill=0)
+        for imgformat in ("PNG", "GIF"):
+            data = BytesIO()
+            img.save(data, imgformat, transparency=2)
+            normalized = Image.open(
+                BytesIO(normalize_image(data.getvalue(), 100, imgformat))
+            )
+            self.assertEqual(normalized.size, (100, 100), "Not scaled down?")
+            normalized = normalized.convert("RGBA")
+            self.assertEqual(normalized.getpixel((50, 10))[3], 0, "Not transparent?")
+            (low, high) = normalized.crop((0, 50, 100, 100)).convert("L").getextrema()
+            self.assertTrue(
+                64 < low <= high < 192, "%s stripes not blended?" % imgformat
+            )
+
+    def test_normalize_animation(self):
+        """
+        Test normalizing animated WebPs and PNGs: they must be scaled down,
+        stay animated and lose their metadata
+        """
+        frames = [Image.new("RGB", (400, 200), color) for color in ("red", "blue")]
+        exif = Image.Exif()
+        exif[0x010E] = "secret"
+        for imgformat in ("WEBP", "PNG"):
+            data = BytesIO()
+            frames[0].save(
+                data,
+                imgformat,
+                save_all=True,
+                append_images=frames[1:],
+                duration=100,
+                loop=0,
+                exif=exif.tobytes(),
+            )
+            normalized = Image.open(
+                BytesIO(normalize_image(data.getvalue(), 100, imgformat))
+            )
+            self.assertEqual(normalized.format, imgformat, "Format changed?")
+            self.assertEqual(normalized.size, (100, 50), "Not scaled down?")
+            self.assertEqual(normalized.n_frames, 2, "Not animated any more?")
+            self.assertNotIn("exif", normalized.info, "%s metadata kept?" % imgformat)
+
+    def test_normalize_small_gif(self):
+        """
+        Test normalizing animated GIFs within the maximum size: they must
+        lose their comments, but keep all of their frames, even more than
+        rendering keeps
+        """
+        frames = []
+        for i in range(150):
+            frame = Image.new("P", (50, 50), 0)
+            ImageDraw.Draw(frame).line((i % 50, 0, i % 50, 49), fill=1 + i // 50)
+            frames.append(frame)
+        data = BytesIO()
+        frames[0].save(
+            data,
+            "GIF",
+            save_all=True,
+            append_images=frames[1:],
+            palette=[255, 0, 0, 0, 0, 255, 0, 255, 0, 0, 0, 0],
+            duration=20,
+            loop=0,
+            comment=b"secret",
+        )
+        normalized = Image.open(BytesIO(normalize_image(data.getvalue(), 100, "GIF")))
+        self.assertEqual(normalized.size, (50, 50), "Resized?")
+        self.assertEqual(normalized.n_frames, 150, "Frames dropped?")
+        self.assertNotIn("comment", normalized.info, "Comment kept?")
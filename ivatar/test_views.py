@@ -5,18 +5,33 @@ Test our views in ivatar.ivataraccount.views and ivatar.views
 # pylint: disable=too-many-lines
 import os
 import json
+import hashlib
+from io import BytesIO
 import django
 from django.test import TestCase
 from django.test import Client
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from PIL import Image, ImageChops
 
-from ivatar.utils import random_string
+from ivatar.utils import mm_ng, random_string
 
 os.environ["DJANGO_SETTINGS_MODULE"] = "ivatar.settings"
 django.setup()
 
+# pylint: disable=wrong-import-position
+from ivatar import views
+from ivatar.views import avatar_cache_key
+from ivatar.render import RenderBusyError
+from ivatar.response_cache import memory_cache
+from ivatar.generators import GENERATOR_VERSION, generated_store
+from ivatar.settings import GENERATED_AVATAR_MASTER_SIZE
+from ivatar.testing import TemporaryCachesMixin
 
-class Tester(TestCase):  # pylint: disable=too-many-public-methods
+# pylint: enable=wrong-import-position
+
+
+class Tester(TemporaryCachesMixin, TestCase):  # pylint: disable=too-many-public-methods
     """
     Main test class
     """
@@ -40,6 +55,7 @@ class Tester(TestCase):  # pylint: disable=too-many-public-methods
         Prepare for tests.
         - Create user
         """
+        super().setUp()
         self.user = User.objects.create_user(
             username=self.username,
             password=self.password,
@@ -76,3 +92,190 @@ class Tester(TestCase):  # pylint: disable=too-many-public-methods
             j["unconfirmed_openids"], 0, "unconfirmed openids count incorrect"
         )
         self.assertEqual(j["avatars"], 0, "avatars count incorrect")
+
+    def test_avatar_cache_key(self):
+        """
+        Test if equivalent avatar requests share one cache key
+        """
+        digest = "%032x" % 0xDEADBEEF
+        key = avatar_cache_key(digest, 80, "mm")
+        self.assertEqual(
+            key, avatar_cache_key(digest.upper(), 80, "mm"), "digest case matters?"
+        )
+        self.assertNotEqual(key, avatar_cache_key(digest, 81, "mm"), "size ignored?")
+        self.assertNotEqual(
+            key, avatar_cache_key(digest, 80, "retro"), "default ignored?"
+        )
+        self.assertNotEqual(
+            key,
+            avatar_cache_key(digest, 80, "mm", forcedefault=True),
+            "forcedefault ignored?",
+        )
+
+    def test_avatar_cache_key_shared(self):
+        """
+        Test if differently spelled, equivalent requests hit the same entry
+        """
+        digest = hashlib.md5(random_string().encode("utf-8")).hexdigest()
+        response = self.client.get(
+            "/avatar/%s?s=80&d=mmng&gravatarproxy=n" % digest, HTTP_HOST="a.example"
+        )
+        self.assertEqual(response.status_code, 200, "unable to fetch avatar?")
+        hits = memory_cache.stats()["hits"]
+        response = self.client.get(
+            "/avatar/%s?gravatarproxy=n&foo=bar&default=mmng&size=80" % digest,
+            HTTP_HOST="b.example",
+        )
+        self.assertEqual(response.status_code, 200, "unable to fetch avatar?")
+        self.assertEqual(
+            memory_cache.stats()["hits"], hits + 1, "equivalent request missed cache"
+        )
+
+    def test_generated_avatar_store(self):
+        """
+        Test if generated defaults are rendered once at the master size,
+        kept in the persistent store and served from there, once the
+        response cache forgot about them
+        """
+        digest = hashlib.md5(random_string().encode("utf-8")).hexdigest()
+        master_size = GENERATED_AVATAR_MASTER_SIZE
+        response = self.client.get("/avatar/%s?s=80&d=mmng&gravatarproxy=n" % digest)
+        self.assertEqual(response.status_code, 200, "unable to fetch avatar?")
+        self.assertEqual(
+            Image.open(BytesIO(response.content)).size,
+            (80, 80),
+            "avatar not scaled down to requested size?",
+        )
+        key = "%s:mmng:%s:%i:None" % (GENERATOR_VERSION, digest, master_size)
+        self.assertIsNotNone(generated_store.get(key), "master not in store?")
+
+        # Whatever is in the store, is served - no need to generate again
+        generated_store.set(key, b"stored")
+        cache_key = avatar_cache_key(digest, master_size, "mmng", gravatarproxy=False)
+        memory_cache.delete(cache_key)
+        caches["filesystem"].delete(cache_key)
+        response = self.client.get(
+            "/avatar/%s?s=%i&d=mmng&gravatarproxy=n" % (digest, master_size)
+        )
+        self.assertEqual(response.content, b"stored", "avatar not served from store?")
+        generated_store.delete(key)
+
+    def test_avatar_format_negotiation(self):
+        """
+        Test if avatars are served as WebP, if the client accepts it (or
+        asks for it), with separate cache entries and ETags per format
+        """
+        digest = hashlib.md5(random_string().encode("utf-8")).hexdigest()
+        url = "/avatar/%s?s=80&d=mmng&gravatarproxy=n" % digest
+        response = self.client.get(url, HTTP_ACCEPT="image/png,image/*;q=0.8")
+        self.assertEqual(response["Content-Type"], "image/png", "not a PNG?")
+        self.assertIn("Accept", response["Vary"], "no Vary: Accept?")
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_ACCEPT="image/webp,image/*;q=0.8")
+        self.assertEqual(response["Content-Type"], "image/webp", "not a WebP?")
+        self.assertEqual(Image.open(BytesIO(response.content)).format, "WEBP")
+        self.assertIn("Accept", response["Vary"], "no Vary: Accept?")
+        self.assertNotEqual(response["ETag"], etag, "same ETag for both formats?")
+
+        # A cached PNG isn't served as WebP or vice versa
+        response = self.client.get(url, HTTP_ACCEPT="image/webp;q=0, image/png")
+        self.assertEqual(response["Content-Type"], "image/png", "not a PNG?")
+        response = self.client.get(url + "&format=webp")
+        self.assertEqual(response["Content-Type"], "image/webp", "not a WebP?")
+
+    def test_webp_animation_support(self):
+        """
+        Test if animated GIFs are served as WebP, if and only if our Pillow
+        can save animated WebPs
+        """
+        frames = [Image.new("RGB", (8, 8), color) for color in ("red", "blue")]
+        data = BytesIO()
+        try:
+            frames[0].save(data, "WEBP", save_all=True, append_images=frames[1:])
+            animated = Image.open(data).n_frames == 2
+        except (KeyError, OSError):
+            animated = False
+        self.assertEqual(views.webp_animation_support(), animated, "wrong support?")
+        self.assertEqual(
+            "webp" in views.ANIMATED_OUTPUT_FORMATS,
+            animated and "webp" in views.OUTPUT_FORMATS,
+            "animated WebP not served?",
+        )
+
+    def test_generated_avatar_palette(self):
+        """
+        Test if generated defaults with few colors are served as (lossless)
+        palette PNGs
+        """
+        digest = hashlib.md5(random_string().encode("utf-8")).hexdigest()
+        reference = mm_ng(idhash=digest, size=GENERATED_AVATAR_MASTER_SIZE)
+        for size in (80, GENERATED_AVATAR_MASTER_SIZE):
+            response = self.client.get(
+                "/avatar/%s?s=%i&d=mmng&gravatarproxy=n" % (digest, size)
+            )
+            img = Image.open(BytesIO(response.content))
+            self.assertEqual(img.mode, "P", "not a palette image?")
+            expected = reference.copy()
+            expected.thumbnail((size, size), Image.ANTIALIAS)
+            self.assertIsNone(
+                ImageChops.difference(img.convert("RGB"), expected).getbbox(),
+                "palette image differs from the generated one?",
+            )
+
+    def test_avatar_render_busy(self):
+        """
+        Test if the static default is served while renders are refused,
+        without it being cached
+        """
+
+        class BusyPool:  # pylint: disable=too-few-public-methods
+            """
+            Render pool with too many renders pending
+            """
+
+            def render(self, *args, **kwargs):
+                """
+                Refuse to render
+                """
+                raise RenderBusyError("Too many renders pending")
+
+        digest = hashlib.md5(random_string().encode("utf-8")).hexdigest()
+        url = "/avatar/%s?s=48&d=mmng&gravatarproxy=n" % digest
+        render_pool = views.render_pool
+        views.render_pool = BusyPool()
+        try:
+            response = self.client.get(url)
+        finally:
+            views.render_pool = render_pool
+        self.assertEqual(response.status_code, 200, "no avatar while busy?")
+        self.assertEqual(response["Cache-Control"], "no-store", "cached?")
+        self.assertEqual(
+            response.content, views.static_default("nobody", 48), "not the default?"
+        )
+
+        response = self.client.get(url)
+        self.assertNotIn("no-store", response["Cache-Control"], "still busy?")
+        self.assertEqual(Image.open(BytesIO(response.content)).size, (48, 48))
+
+    def test_generated_avatar_etag_version(self):
+        """
+        Test if the ETags of generated defaults change with the version of
+        our generators, so clients don't keep outdated renderings
+        """
+        digest = hashlib.md5(random_string().encode("utf-8")).hexdigest()
+        url = "/avatar/%s?s=80&d=mmng&gravatarproxy=n" % digest
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304, "not revalidated?")
+
+        cache_key = avatar_cache_key(digest, 80, "mmng", gravatarproxy=False)
+        memory_cache.delete(cache_key)
+        caches["filesystem"].delete(cache_key)
+        views.GENERATOR_VERSION = GENERATOR_VERSION + 1
+        try:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        finally:
+            views.GENERATOR_VERSION = GENERATOR_VERSION
+        self.assertEqual(response.status_code, 200, "outdated rendering kept?")
+        self.assertNotEqual(response["ETag"], etag, "same ETag for new version?")
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by our tests
+"""
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test.utils import override_settings
+
+from ivatar.generators import generated_store
+from ivatar.gravatar import gravatar_images
+from ivatar.response_cache import memory_cache
+
+
+class TemporaryCachesMixin:
+    """
+    Test case mixin keeping the caches and stores of every test apart from
+    those in use: the default cache is kept in memory, the filesystem cache
+    and the persistent stores in a temporary directory
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.temporary_caches = override_settings(
+            CACHES=dict(
+                settings.CACHES,
+                default={
+                    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                },
+                filesystem=dict(
+                    settings.CACHES["filesystem"],
+                    LOCATION=os.path.join(self.tmpdir, "cache"),
+                ),
+            )
+        )
+        self.temporary_caches.enable()
+        caches["default"].clear()
+        memory_cache.clear()
+        self.saved_locations = (
+            generated_store.location,
+            gravatar_images.store.location,
+        )
+        generated_store.location = os.path.join(self.tmpdir, "generated")
+        gravatar_images.store.location = os.path.join(self.tmpdir, "gravatar")
+
+    def tearDown(self):
+        (
+            generated_store.location,
+            gravatar_images.store.location,
+        ) = self.saved_locations
+        self.temporary_caches.disable()
+        memory_cache.clear()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        super().tearDown()
@@ -2,12 +2,24 @@
 """
 Simple module providing reusable random_string function
 """
+import math
 import random
 import string
+from functools import lru_cache
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageSequence
+from PIL import Image, ImageDraw, ImageOps, ImageSequence
 from urllib.parse import urlparse
 
+try:
+    # Registers the AVIF plugin, in every process encoding images (that
+    # includes the render processes, which never import the views)
+    import pillow_avif  # noqa: F401 pylint: disable=unused-import
+except ImportError:  # pragma: no cover
+    pass
+
+from ivatar.settings import ANIMATION_MAX_FRAMES, ANIMATION_MAX_PIXELS
+from ivatar.settings import PHOTO_MASTER_MAX_FRAMES, PHOTO_MASTER_MAX_PIXELS
+
 
 def random_string(length=10):
     """
@@ -41,19 +53,12 @@ def openid_variations(openid):
     return (openid, var1, var2, var3)
 
 
-def mm_ng(
-    idhash, size=80, add_red=0, add_green=0, add_blue=0
-):  # pylint: disable=too-many-locals
+@lru_cache(maxsize=32)
+def mm_ng_mask(size):
     """
-    Return an MM (mystery man) image, based on a given hash
-    add some red, green or blue, if specified
+    Return the mask of the MM (mystery man) silhouette for the given size;
+    it doesn't depend on anything else, so it's only drawn once per size
     """
-
-    # Make sure the lightest bg color we paint is e0, else
-    # we do not see the MM any more
-    if idhash[0] == "f":
-        idhash = "e0"
-
     # How large is the circle?
     circlesize = size * 0.6
 
@@ -63,45 +68,11 @@ def mm_ng(
     start_y = int(size * 0.05)
     end_y = start_y + circlesize
 
-    # All are the same, based on the input hash
-    # this should always result in a "gray-ish" background
-    red = idhash[0:2]
-    green = idhash[0:2]
-    blue = idhash[0:2]
-
-    # Add some red (i/a) and make sure it's not over 255
-    red = hex(int(red, 16) + add_red).replace("0x", "")
-    if int(red, 16) > 255:
-        red = "ff"
-    if len(red) == 1:
-        red = "0%s" % red
-
-    # Add some green (i/a) and make sure it's not over 255
-    green = hex(int(green, 16) + add_green).replace("0x", "")
-    if int(green, 16) > 255:
-        green = "ff"
-    if len(green) == 1:
-        green = "0%s" % green
-
-    # Add some blue (i/a) and make sure it's not over 255
-    blue = hex(int(blue, 16) + add_blue).replace("0x", "")
-    if int(blue, 16) > 255:
-        blue = "ff"
-    if len(blue) == 1:
-        blue = "0%s" % blue
-
-    # Assemable the bg color "string" in webnotation. Eg. '#d3d3d3'
-    bg_color = "#" + red + green + blue
-
-    # Image
-    image = Image.new("RGB", (size, size))
-    draw = ImageDraw.Draw(image)
-
-    # Draw background
-    draw.rectangle(((0, 0), (size, size)), fill=bg_color)
+    mask = Image.new("L", (size, size))
+    draw = ImageDraw.Draw(mask)
 
     # Draw MMs head
-    draw.ellipse((start_x, start_y, end_x, end_y), fill="white")
+    draw.ellipse((start_x, start_y, end_x, end_y), fill=255)
 
     # Draw MMs 'body'
     draw.polygon(
@@ -110,9 +81,34 @@ def mm_ng(
             (size * 0.15, size),
             (size - size * 0.15, size),
         ),
-        fill="white",
+        fill=255,
     )
+    return mask
+
 
+def mm_ng(idhash, size=80, add_red=0, add_green=0, add_blue=0):
+    """
+    Return an MM (mystery man) image, based on a given hash
+    add some red, green or blue, if specified
+    """
+
+    # Make sure the lightest bg color we paint is e0, else
+    # we do not see the MM any more
+    if idhash[0] == "f":
+        idhash = "e0"
+
+    # All are the same, based on the input hash
+    # this should always result in a "gray-ish" background,
+    # plus some red, green or blue (i/a), but not over 255
+    gray = int(idhash[0:2], 16)
+    bg_color = (
+        min(gray + add_red, 255),
+        min(gray + add_green, 255),
+        min(gray + add_blue, 255),
+    )
+
+    image = Image.new("RGB", (size, size), bg_color)
+    image.paste("white", mask=mm_ng_mask(size))
     return image
 
 
@@ -161,23 +157,254 @@ def is_trusted_url(url, url_filters):
     return False
 
 
-def resize_animated_gif(input_pil: Image, size: list) -> BytesIO:
-    def _thumbnail_frames(image):
-        for frame in ImageSequence.Iterator(image):
-            new_frame = frame.copy()
-            new_frame.thumbnail(size)
-            yield new_frame
+# Downscaling first reduces JPEGs while decoding them (DCT scaling, see
+# Image.draft()) and other images by binning, to reducing_gap times the
+# target size, only the rest is done by (expensive) resampling. With 2.0
+# the result is very close to resampling all the way, None disables it
+RESIZE_REDUCING_GAP = 2.0
+
+# JPEGs to be scaled down are decoded at a reduced scale right away, to
+# no less than JPEG_DRAFT_GAP times the target size. Decoding only the
+# lower frequencies is a proper downscale in itself: at 1.0 the result
+# differs from resampling all the way by a level or two (of 255) per
+# channel, at a fraction of the time (see benchmarks/resize.py), None
+# disables it
+JPEG_DRAFT_GAP = 1.0
+
 
-    frames = list(_thumbnail_frames(input_pil))
+def _gif_palette(rgba):
+    """
+    Return a palette image of the (at most 255) colours of the RGBA image,
+    the entry after them is left for the transparent one
+    """
+    colors = rgba.getcolors(255)
+    if colors:
+        palette = Image.new("P", (1, 1))
+        palette.putpalette(
+            [
+                value
+                for color in sorted({c[:3] for (_, c) in colors if c[3]})
+                for value in color
+            ]
+        )
+        return palette
+    # More colours than a palette can hold. The palette quantize() returns
+    # has 256 entries, whatever is used: keep 255
+    palette = rgba.convert("RGB").quantize(255)
+    values = palette.getpalette()[: 255 * 3]
+    palette.putpalette(values + [0] * (255 * 3 - len(values)))
+    return palette
+
+
+def _gif_quantize(rgba, palette):
+    """
+    Return the RGBA image as palette image, mapped to the colours of the
+    palette, with the (mostly) transparent pixels transparent
+    """
+    frame = rgba.convert("RGB").quantize(palette=palette, dither=Image.Dither.NONE)
+    frame.info.pop("transparency", None)
+    # The entry after the colours is the transparent one
+    transparency = len(palette.getpalette()) // 3
+    mask = rgba.getchannel("A").point([255] * 128 + [0] * 128)
+    if mask.getbbox():
+        frame.paste(transparency, mask=mask)
+        frame.info["transparency"] = transparency
+    return frame
+
+
+def _gif_frames(input_pil, size, step, reducing_gap, paletted=True):
+    """
+    Resize the frames of an animated GIF one by one, yielding every step'th
+    of them, with the display time of the dropped frames added. Resizing
+    blends colours, paletted results are mapped back to the colours the
+    frame had, rather than quantizing them anew
+    """
+    frame = None
+    for (index, source) in enumerate(ImageSequence.Iterator(input_pil)):
+        if index % step == 0:
+            if frame is not None:
+                yield frame
+            rgba = source.convert("RGBA")
+            # Only the display time is kept, no comments etc.
+            rgba.info = {}
+            if paletted:
+                # Frames with more colours mix the palettes of several
+                # (partial) frames
+                palette = _gif_palette(rgba)
+            # Resampled with premultiplied alpha, so transparent pixels don't
+            # bleed into the edges. Converting to it up front is a lot faster
+            # than resampling RGBA, which converts back and forth at each step
+            rgba = rgba.convert("RGBa")
+            rgba.thumbnail(size, reducing_gap=reducing_gap)
+            frame = rgba = rgba.convert("RGBA")
+            if paletted:
+                frame = _gif_quantize(rgba, palette)
+            frame.info["duration"] = 0
+        frame.info["duration"] += source.info.get("duration", 0)
+    yield frame
+
+
+def resize_animated_gif(
+    input_pil: Image,
+    size: list,
+    max_frames=ANIMATION_MAX_FRAMES,
+    max_pixels=ANIMATION_MAX_PIXELS,
+    reducing_gap=RESIZE_REDUCING_GAP,
+    pil_format="GIF",
+    quality=85,
+) -> BytesIO:
+    """
+    Resize an animated GIF, decoding and resizing one frame at a time.
+    Animations of more than max_frames frames, or more than max_pixels
+    pixels in all frames together, are decimated to stay within both.
+    The result is an animated GIF, or an animated WebP with pil_format
+    "WEBP", which is a lot smaller, or an animated PNG with "PNG"
+    """
+    (width, height) = input_pil.size
+    scale = min(1, size[0] / width, size[1] / height)
+    frame_pixels = max(1, round(width * scale)) * max(1, round(height * scale))
+    frames = min(input_pil.n_frames, max_frames, max(1, max_pixels // frame_pixels))
+    step = math.ceil(input_pil.n_frames / frames)
     output = BytesIO()
-    output_image = frames[0]
-    output_image.save(
+
+    if pil_format in ("WEBP", "PNG"):
+        # These encoders want all frames, and their display times, at
+        # once. They're resized already, within the budgets
+        resized = list(_gif_frames(input_pil, size, step, reducing_gap, False))
+        resized[0].save(
+            output,
+            format=pil_format,
+            save_all=True,
+            append_images=resized[1:],
+            duration=[frame.info["duration"] for frame in resized],
+            # GIFs without a loop count are played once
+            loop=input_pil.info.get("loop", 1),
+            quality=quality,
+        )
+        return output
+
+    params = {
+        key: value
+        for (key, value) in input_pil.info.items()
+        if key in ("loop", "background")
+    }
+    # Frames are complete images, transparent areas must be cleared
+    params["disposal"] = 2 if "transparency" in input_pil.info else 1
+
+    resized = _gif_frames(input_pil, size, step, reducing_gap)
+    next(resized).save(
         output,
         format="gif",
         save_all=True,
         optimize=False,
-        append_images=frames[1:],
-        disposal=input_pil.disposal_method,
-        **input_pil.info,
+        append_images=resized,
+        **params,
     )
     return output
+
+
+def resize_image(
+    data,
+    size,
+    pil_format,
+    quality=85,
+    reducing_gap=RESIZE_REDUCING_GAP,
+    square=True,
+    draft_gap=JPEG_DRAFT_GAP,
+):  # pylint: disable=too-many-arguments
+    """
+    Decode the given image data, resize it to size x size and return
+    the re-encoded bytes (pil_format being the PIL encoder name). With
+    square=False it's only scaled down to fit into size x size, keeping
+    its aspect ratio
+    """
+    photodata = Image.open(BytesIO(data))
+    if draft_gap and photodata.format == "JPEG":
+        # Before anything decodes it; never below size x size
+        photodata.draft("RGB", (round(size * draft_gap), round(size * draft_gap)))
+
+    # Animated GIFs need additional handling, they stay animated as WebP
+    if getattr(photodata, "is_animated", False) and (
+        pil_format == "GIF" or (pil_format == "WEBP" and photodata.format == "GIF")
+    ):
+        return resize_animated_gif(
+            photodata, (size, size), pil_format=pil_format, quality=quality
+        ).getvalue()
+
+    # Palette images would only be resized with the nearest neighbour
+    # (GIFs stay palette images, to keep their transparency)
+    if photodata.mode == "P" and pil_format != "GIF":
+        photodata = photodata.convert(
+            "RGBA" if "transparency" in photodata.info else "RGB"
+        )
+
+    output = BytesIO()
+    # If the image is smaller than what was requested, we need
+    # to use the function resize
+    if square and (photodata.size[0] < size or photodata.size[1] < size):
+        photodata = photodata.resize((size, size), Image.ANTIALIAS)
+    else:
+        photodata.thumbnail((size, size), Image.ANTIALIAS, reducing_gap=reducing_gap)
+    photodata.save(output, pil_format, quality=quality)
+    return output.getvalue()
+
+
+def normalize_image(
+    data, max_size, pil_format, quality=85, reducing_gap=RESIZE_REDUCING_GAP
+):
+    """
+    Prepare the image data of a new photo: apply the EXIF orientation,
+    drop the metadata and scale it down to fit into max_size x max_size,
+    re-encoding it once (pil_format being the PIL encoder name)
+    """
+    photodata = Image.open(BytesIO(data))
+
+    # Animations are resized frame by frame, keeping all frames (those of
+    # the rendering budgets are dropped when rendering, not from the
+    # original), within the far higher bounds for originals. They're
+    # always re-encoded, even if they're small enough already, which drops
+    # their metadata (MPO files are JPEGs with additional images, not
+    # animations)
+    if pil_format != "JPEG" and getattr(photodata, "is_animated", False):
+        return resize_animated_gif(
+            photodata,
+            (max_size, max_size),
+            max_frames=PHOTO_MASTER_MAX_FRAMES,
+            max_pixels=PHOTO_MASTER_MAX_PIXELS,
+            pil_format=pil_format,
+            quality=quality,
+        ).getvalue()
+
+    # Scale down first: rotating would decode the image at full size, while
+    # scaling down (into a square) decodes JPEGs at a reduced scale
+    if max(photodata.size) > max_size:
+        # Palette images would only be resized with the nearest neighbour
+        if photodata.mode == "P":
+            transparent = "transparency" in photodata.info
+            rgba = photodata.convert("RGBA").convert("RGBa")
+            rgba.thumbnail((max_size, max_size), reducing_gap=reducing_gap)
+            photodata = rgba.convert("RGBA")
+            if pil_format == "GIF":
+                # The blended colours make a new palette
+                photodata = _gif_quantize(photodata, _gif_palette(photodata))
+            elif not transparent:
+                photodata = photodata.convert("RGB")
+        else:
+            photodata.thumbnail(
+                (max_size, max_size), Image.ANTIALIAS, reducing_gap=reducing_gap
+            )
+    photodata = ImageOps.exif_transpose(photodata)
+    # Only keep what's needed to display the image, no EXIF, comments etc.
+    photodata.info = {
+        key: value
+        for (key, value) in photodata.info.items()
+        if key in ("transparency", "background", "icc_profile")
+    }
+    output = BytesIO()
+    photodata.save(
+        output,
+        pil_format,
+        quality=quality,
+        icc_profile=photodata.info.get("icc_profile"),
+    )
+    return output.getvalue()
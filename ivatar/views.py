@@ -3,40 +3,60 @@
 views under /
 """
 from io import BytesIO
-from os import path
 import hashlib
-from urllib.request import urlopen
-from urllib.error import HTTPError, URLError
-from ssl import SSLError
 from django.views.generic.base import TemplateView, View
 from django.http import HttpResponse, HttpResponseRedirect
 from django.http import HttpResponseNotFound, JsonResponse
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.cache import cache, caches
 from django.utils.translation import gettext_lazy as _
 from django.urls import reverse_lazy
-from django.db.models import Q
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 from django.contrib.auth.models import User
+from django.contrib.staticfiles import finders
+from PIL import Image, features
 
-from PIL import Image
-
-from monsterid.id import build_monster as BuildMonster
-import Identicon
-from pydenticon5 import Pydenticon5
-import pagan
-from robohash import Robohash
-
-from ivatar.settings import AVATAR_MAX_SIZE, JPEG_QUALITY, DEFAULT_AVATAR_SIZE
+from ivatar.settings import AVATAR_MAX_SIZE, DEFAULT_AVATAR_SIZE
+from ivatar.settings import AVATAR_FORMATS, JPEG_QUALITY
 from ivatar.settings import CACHE_RESPONSE
 from ivatar.settings import CACHE_IMAGES_MAX_AGE
 from ivatar.settings import TRUSTED_DEFAULT_URLS
 from .ivataraccount.models import ConfirmedEmail, ConfirmedOpenId
 from .ivataraccount.models import UnconfirmedEmail, UnconfirmedOpenId
-from .ivataraccount.models import Photo
-from .ivataraccount.models import pil_format, file_format
-from .utils import is_trusted_url, mm_ng, resize_animated_gif
+from .ivataraccount.models import Photo, AvatarDigest
+from .ivataraccount.models import pil_format
+from .ivataraccount.counters import access_counter
+from .utils import is_trusted_url, resize_image
+from .generators import GENERATED_DEFAULTS, GENERATOR_VERSION, generated_avatar
+from .render import RenderBusyError, render_pool
+from .gravatar import GravatarError, gravatar_image_shared, stored_gravatar_image
+from .response_cache import get_cached_response, set_cached_response
+from .response_cache import memory_cache
+
+Image.init()
+# The formats of AVATAR_FORMATS our Pillow can encode
+OUTPUT_FORMATS = tuple(
+    imgformat for imgformat in AVATAR_FORMATS if pil_format(imgformat) in Image.SAVE
+)
+
+
+def webp_animation_support():
+    """
+    Return if our Pillow can save animated WebPs: newer ones don't know the
+    webp_anim feature any more, every WebP module they build supports them
+    """
+    try:
+        return bool(features.check_feature("webp_anim"))
+    except ValueError:
+        return bool(features.check_module("webp"))
 
-URL_TIMEOUT = 5  # in seconds
+
+# The ones of them animated GIFs can be served in, see resize_animated_gif()
+ANIMATED_OUTPUT_FORMATS = tuple(
+    imgformat
+    for imgformat in OUTPUT_FORMATS
+    if imgformat == "webp" and webp_animation_support()
+)
 
 
 def get_size(request, size=DEFAULT_AVATAR_SIZE):
@@ -63,6 +83,88 @@ def get_size(request, size=DEFAULT_AVATAR_SIZE):
     return size
 
 
+def get_format(request, formats=OUTPUT_FORMATS):
+    """
+    Get the format (of formats) to serve the avatar in, if not its own: the
+    one asked for with ?format=, else the most preferred one the client
+    accepts
+    """
+    if request.GET.get("format") in formats:
+        return request.GET["format"]
+    accepted = set()
+    for item in request.META.get("HTTP_ACCEPT", "").split(","):
+        (media_type, *params) = [part.strip() for part in item.split(";")]
+        try:
+            if any(float(p[2:]) == 0 for p in params if p.startswith("q=")):
+                continue
+        except ValueError:
+            continue
+        accepted.add(media_type.lower())
+    for imgformat in formats:
+        if "image/%s" % imgformat in accepted:
+            return imgformat
+    return None
+
+
+def avatar_cache_key(
+    digest,
+    size,
+    default=None,
+    forcedefault=False,
+    gravatarredirect=False,
+    gravatarproxy=True,
+    roboset=None,
+    imgformat=None,
+    animatedformat=None,
+):  # pylint: disable=too-many-arguments
+    """
+    Build the cache key for an avatar response from the (already parsed
+    and validated) request arguments, so it doesn't depend on how they
+    were spelled out in the URL
+    """
+    canonical = "|".join(
+        str(arg)
+        for arg in (
+            digest.lower(),
+            size,
+            default,
+            forcedefault,
+            gravatarredirect,
+            gravatarproxy,
+            roboset,
+            imgformat,
+            animatedformat,
+        )
+    )
+    # Defaults may be (long) URLs, keep the key short and safe for any backend
+    return "avatar:%s" % hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def make_etag(*parts):
+    """
+    Return a strong ETag, built from the given parts, which must describe
+    the content of the response unambiguously
+    """
+    canonical = "|".join(str(part) for part in parts)
+    return quote_etag(hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32])
+
+
+def not_modified_response(request, etag=None, last_modified=None):
+    """
+    Return a 304 Not Modified response, if the copy of the client
+    (If-None-Match / If-Modified-Since) is still valid, else None
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None or response.status_code != 304:
+        return None
+    if etag:
+        response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
+    return response
+
+
 class CachingHttpResponse(HttpResponse):
     """
     Handle caching of response
@@ -70,25 +172,86 @@ class CachingHttpResponse(HttpResponse):
 
     def __init__(
         self,
-        uri,
+        key,
         content=b"",
         content_type=None,
         status=200,  # pylint: disable=too-many-arguments
         reason=None,
         charset=None,
+        etag=None,
+        last_modified=None,
     ):
+        if isinstance(content, BytesIO):
+            content = content.getvalue()
         if CACHE_RESPONSE:
-            caches["filesystem"].set(
-                uri,
+            set_cached_response(
+                key,
                 {
                     "content": content,
                     "content_type": content_type,
                     "status": status,
                     "reason": reason,
                     "charset": charset,
+                    "etag": etag,
+                    "last_modified": last_modified,
                 },
             )
         super().__init__(content, content_type, status, reason, charset)
+        if etag:
+            self["ETag"] = etag
+        if last_modified:
+            self["Last-Modified"] = http_date(last_modified)
+
+
+def static_default(name, size):
+    """
+    Return the data of our static default image (nobody or mm), as PNG
+    """
+    filename = finders.find("img/%s/%i.png" % (name, size))
+    if not filename:
+        # We trust this exists!!!
+        filename = finders.find("img/%s/512.png" % name)
+    with open(filename, "rb") as image:
+        return image.read()
+
+
+def busy_response(size, name="nobody"):
+    """
+    Return our static default image, when there are too many renders
+    pending to render the avatar asked for. It's not cached, neither by
+    us nor by the client, the next request gets the real avatar again
+    """
+    response = HttpResponse(static_default(name, size), content_type="image/png")
+    response["Cache-Control"] = "no-store"
+    return response
+
+
+def static_default_response(request, cache_key, name, size, imgformat=None):
+    """
+    Return our static default image (nobody or mm) in the requested size
+    (and format), rather than redirecting the client there
+    """
+    # New renderings must not be taken for the ones clients still have
+    etag = make_etag(cache_key, GENERATOR_VERSION)
+    response = not_modified_response(request, etag)
+    if response:
+        return response
+    data = static_default(name, size)
+    if imgformat:
+        try:
+            data = render_pool.render(
+                resize_image, data, size, pil_format(imgformat), JPEG_QUALITY
+            )
+        except RenderBusyError:
+            return busy_response(size, name)
+    response = CachingHttpResponse(
+        cache_key,
+        data,
+        content_type="image/%s" % (imgformat or "png"),
+        etag=etag,
+    )
+    response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
+    return response
 
 
 class AvatarImageView(TemplateView):
@@ -96,45 +259,42 @@ class AvatarImageView(TemplateView):
     View to return (binary) image, based on OpenID/Email (both by digest)
     """
 
-    # TODO: Do cache resize images!! Memcached?
-
     def options(self, request, *args, **kwargs):
         response = HttpResponse("", content_type="text/plain")
         response["Allow"] = "404 mm mp retro pagan wavatar monsterid robohash identicon"
         return response
 
-    def get(
+    def get(self, request, *args, **kwargs):
+        """
+        Override get from parent class
+        """
+        response = self.avatar(request, *args, **kwargs)
+        # The format served may depend on what the client accepts
+        if OUTPUT_FORMATS:
+            patch_vary_headers(response, ("Accept",))
+        return response
+
+    def avatar(
         self, request, *args, **kwargs
     ):  # pylint: disable=too-many-branches,too-many-statements,too-many-locals,too-many-return-statements
         """
-        Override get from parent class
+        Return the avatar response
         """
-        model = ConfirmedEmail
         size = get_size(request)
-        imgformat = "png"
+        imgformat = get_format(request)
+        # (Possibly) animated GIFs can only be served in some formats
+        animatedformat = get_format(request, ANIMATED_OUTPUT_FORMATS)
         obj = None
         default = None
         forcedefault = False
         gravatarredirect = False
         gravatarproxy = True
-        uri = request.build_absolute_uri()
-
-        # Check the cache first
-        if CACHE_RESPONSE:
-            centry = caches["filesystem"].get(uri)
-            if centry:
-                # For DEBUG purpose only print('Cached entry for %s' % uri)
-                return HttpResponse(
-                    centry["content"],
-                    content_type=centry["content_type"],
-                    status=centry["status"],
-                    reason=centry["reason"],
-                    charset=centry["charset"],
-                )
+        roboset = None
 
         # In case no digest at all is provided, return to home page
         if "digest" not in kwargs:
             return HttpResponseRedirect(reverse_lazy("home"))
+        digest = kwargs["digest"].lower()
 
         if "d" in request.GET:
             default = request.GET["d"]
@@ -171,33 +331,57 @@ class AvatarImageView(TemplateView):
             if request.GET["gravatarproxy"] == "n":
                 gravatarproxy = False
 
+        if str(default) == "robohash":
+            roboset = request.GET.get("robohash") or "any"
+
+        # Equivalent requests (parameter order or aliases, host names,
+        # unrelated parameters) share one cache entry
+        cache_key = avatar_cache_key(
+            digest,
+            size,
+            default,
+            forcedefault=forcedefault,
+            gravatarredirect=gravatarredirect,
+            gravatarproxy=gravatarproxy,
+            roboset=roboset,
+            imgformat=imgformat,
+            animatedformat=animatedformat,
+        )
+
+        # Check the cache first
+        if CACHE_RESPONSE:
+            centry = get_cached_response(cache_key)
+            if centry:
+                etag = centry.get("etag")
+                last_modified = centry.get("last_modified")
+                response = not_modified_response(request, etag, last_modified)
+                if response:
+                    return response
+                response = HttpResponse(
+                    centry["content"],
+                    content_type=centry["content_type"],
+                    status=centry["status"],
+                    reason=centry["reason"],
+                    charset=centry["charset"],
+                )
+                if etag:
+                    response["ETag"] = etag
+                if last_modified:
+                    response["Last-Modified"] = http_date(last_modified)
+                response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
+                return response
+
+        # One primary key lookup in the digest index resolves mail
+        # addresses (md5 and sha256) as well as all OpenID variations
         try:
-            obj = model.objects.get(digest=kwargs["digest"])
+            obj = AvatarDigest.objects.get(digest=digest)  # pylint: disable=no-member
         except ObjectDoesNotExist:
-            try:
-                obj = model.objects.get(digest_sha256=kwargs["digest"])
-            except ObjectDoesNotExist:
-                model = ConfirmedOpenId
-                try:
-                    d = kwargs["digest"]  # pylint: disable=invalid-name
-                    # OpenID is tricky. http vs. https, versus trailing slash or not
-                    # However, some users eventually have added their variations already
-                    # and therfore we need to use filter() and first()
-                    obj = model.objects.filter(
-                        Q(digest=d)
-                        | Q(alt_digest1=d)
-                        | Q(alt_digest2=d)
-                        | Q(alt_digest3=d)
-                    ).first()
-                except Exception:  # pylint: disable=bare-except
-                    pass
+            pass
 
         # If that mail/openid doesn't exist, or has no photo linked to it
-        if not obj or not obj.photo or forcedefault:
+        if not obj or not obj.photo_id or forcedefault:
             gravatar_url = (
-                "https://secure.gravatar.com/avatar/"
-                + kwargs["digest"]
-                + "?s=%i" % size
+                "https://secure.gravatar.com/avatar/" + digest + "?s=%i" % size
             )
 
             # If we have redirection to Gravatar enabled, this overrides all
@@ -205,157 +389,126 @@ class AvatarImageView(TemplateView):
             if gravatarredirect and not forcedefault:
                 return HttpResponseRedirect(gravatar_url)
 
-            # Request to proxy Gravatar image - only if not forcedefault
-            if gravatarproxy and not forcedefault:
-                url = (
-                    reverse_lazy("gravatarproxy", args=[kwargs["digest"]])
-                    + "?s=%i" % size
-                )
-                # Ensure we do not convert None to string 'None'
-                if default:
-                    url += "&default=%s" % default
-                return HttpResponseRedirect(url)
-
-            # Return the default URL, as specified, or 404 Not Found, if default=404
-            if default:
-                # Proxy to gravatar to generate wavatar - lazy me
-                if str(default) == "wavatar":
-                    url = (
-                        reverse_lazy("gravatarproxy", args=[kwargs["digest"]])
-                        + "?s=%i" % size
-                        + "&default=%s&f=y" % default
+            # Gravatar's image is served right here, if it's stored already,
+            # as is our default, if Gravatar is known to have none. Anything
+            # else is left to the (asynchronous) proxy, rather than blocking
+            # this worker while asking Gravatar - only if not forcedefault.
+            # Gravatar generates wavatars for us, too
+            if (gravatarproxy and not forcedefault) or str(default) == "wavatar":
+                image = stored_gravatar_image(digest, size, default)
+                if image:
+                    response = CachingHttpResponse(
+                        cache_key, image[0], content_type=image[1]
                     )
-                    return HttpResponseRedirect(url)
-
-                if str(default) == str(404):
-                    return HttpResponseNotFound(_("<h1>Image not found</h1>"))
-
-                if str(default) == "monsterid":
-                    monsterdata = BuildMonster(seed=kwargs["digest"], size=(size, size))
-                    data = BytesIO()
-                    monsterdata.save(data, "PNG", quality=JPEG_QUALITY)
-                    data.seek(0)
-                    response = CachingHttpResponse(uri, data, content_type="image/png")
-                    response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
-                    return response
-
-                if str(default) == "robohash":
-                    roboset = "any"
-                    if request.GET.get("robohash"):
-                        roboset = request.GET.get("robohash")
-                    robohash = Robohash(kwargs["digest"])
-                    robohash.assemble(roboset=roboset, sizex=size, sizey=size)
-                    data = BytesIO()
-                    robohash.img.save(data, format="png")
-                    data.seek(0)
-                    response = CachingHttpResponse(uri, data, content_type="image/png")
-                    response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
-                    return response
-
-                if str(default) == "retro":
-                    identicon = Identicon.render(kwargs["digest"])
-                    data = BytesIO()
-                    img = Image.open(BytesIO(identicon))
-                    img = img.resize((size, size), Image.ANTIALIAS)
-                    img.save(data, "PNG", quality=JPEG_QUALITY)
-                    data.seek(0)
-                    response = CachingHttpResponse(uri, data, content_type="image/png")
                     response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
                     return response
+                if image is None:
+                    url = reverse_lazy("gravatarproxy", args=[digest]) + "?s=%i" % size
+                    # Ensure we do not convert None to string 'None'
+                    if default:
+                        url += "&default=%s" % default
+                    return HttpResponseRedirect(url)
 
-                if str(default) == "pagan":
-                    paganobj = pagan.Avatar(kwargs["digest"])
-                    data = BytesIO()
-                    img = paganobj.img.resize((size, size), Image.ANTIALIAS)
-                    img.save(data, "PNG", quality=JPEG_QUALITY)
-                    data.seek(0)
-                    response = CachingHttpResponse(uri, data, content_type="image/png")
-                    response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
-                    return response
+            return self.default_response(
+                request, cache_key, digest, size, default, roboset, imgformat
+            )
 
-                if str(default) == "identicon":
-                    p = Pydenticon5()  # pylint: disable=invalid-name
-                    # In order to make use of the whole 32 bytes digest, we need to redigest them.
-                    newdigest = hashlib.md5(
-                        bytes(kwargs["digest"], "utf-8")
-                    ).hexdigest()
-                    img = p.draw(newdigest, size, 0)
-                    data = BytesIO()
-                    img.save(data, "PNG", quality=JPEG_QUALITY)
-                    data.seek(0)
-                    response = CachingHttpResponse(uri, data, content_type="image/png")
-                    response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
-                    return response
+        # Only the metadata of the photo is loaded, the image itself is
+        # served from the rendition store
+        photo = Photo.objects.get(pk=obj.photo_id)  # pylint: disable=no-member
+        # Animated GIFs are served as GIFs or in a format supporting
+        # animations, still ones like any other photo
+        if photo.format == "gif" and photo.is_animated():
+            imgformat = animatedformat or photo.format
+        elif not imgformat:
+            imgformat = photo.format
+
+        # Answer revalidations before loading or processing any image data
+        etag = make_etag("photo", photo.pk, photo.last_modified, size, imgformat)
+        last_modified = int(max(photo.last_modified, obj.last_modified).timestamp())
+        response = not_modified_response(request, etag, last_modified)
+        if response:
+            return response
 
-                if str(default) == "mmng":
-                    mmngimg = mm_ng(idhash=kwargs["digest"], size=size)
-                    data = BytesIO()
-                    mmngimg.save(data, "PNG", quality=JPEG_QUALITY)
-                    data.seek(0)
-                    response = CachingHttpResponse(uri, data, content_type="image/png")
-                    response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
-                    return response
+        try:
+            data = BytesIO(photo.get_rendition(size, imgformat))
+        except RenderBusyError:
+            return busy_response(size)
 
-                if str(default) == "mm" or str(default) == "mp":
-                    # If mm is explicitly given, we need to catch that
-                    static_img = path.join(
-                        "static", "img", "mm", "%s%s" % (str(size), ".png")
-                    )
-                    if not path.isfile(static_img):
-                        # We trust this exists!!!
-                        static_img = path.join("static", "img", "mm", "512.png")
-                    # We trust static/ is mapped to /static/
-                    return HttpResponseRedirect("/" + static_img)
-                return HttpResponseRedirect(default)
-
-            static_img = path.join(
-                "static", "img", "nobody", "%s%s" % (str(size), ".png")
-            )
-            if not path.isfile(static_img):
-                # We trust this exists!!!
-                static_img = path.join("static", "img", "nobody", "512.png")
-            # We trust static/ is mapped to /static/
-            return HttpResponseRedirect("/" + static_img)
-
-        imgformat = obj.photo.format
-        photodata = Image.open(BytesIO(obj.photo.data))
-
-        data = BytesIO()
-
-        # Animated GIFs need additional handling
-        if imgformat == "gif" and photodata.is_animated:
-            # Debug only
-            # print("Object is animated and has %i frames" % photodata.n_frames)
-            data = resize_animated_gif(photodata, (size, size))
-        else:
-            # If the image is smaller than what was requested, we need
-            # to use the function resize
-            if photodata.size[0] < size or photodata.size[1] < size:
-                photodata = photodata.resize((size, size), Image.ANTIALIAS)
-            else:
-                photodata.thumbnail((size, size), Image.ANTIALIAS)
-            photodata.save(data, pil_format(imgformat), quality=JPEG_QUALITY)
-
-        data.seek(0)
-        obj.photo.access_count += 1
-        obj.photo.save()
-        obj.access_count += 1
-        obj.save()
+        # Counted in memory, written to the database later on
+        access_counter.record(Photo, photo.pk)
+        access_counter.record(obj.owner_model, obj.owner_id)
         if imgformat == "jpg":
             imgformat = "jpeg"
-        response = CachingHttpResponse(uri, data, content_type="image/%s" % imgformat)
+        response = CachingHttpResponse(
+            cache_key,
+            data,
+            content_type="image/%s" % imgformat,
+            etag=etag,
+            last_modified=last_modified,
+        )
         response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
         return response
 
+    def default_response(
+        self, request, cache_key, digest, size, default, roboset, imgformat
+    ):  # pylint: disable=too-many-arguments,no-self-use,too-many-return-statements
+        """
+        Return the default avatar asked for: a generated or static one, a
+        redirect to the default URL, or 404 Not Found, if default=404
+        """
+        # Return the default URL, as specified, or 404 Not Found, if default=404
+        if default and str(default) != "wavatar":
+            if str(default) == str(404):
+                return HttpResponseNotFound(_("<h1>Image not found</h1>"))
+
+            # Generated defaults only depend on the request arguments and
+            # the version of our generators
+            etag = make_etag(cache_key, GENERATOR_VERSION)
+            if str(default) in GENERATED_DEFAULTS:
+                response = not_modified_response(request, etag)
+                if response:
+                    return response
+                try:
+                    data = render_pool.render(
+                        generated_avatar,
+                        str(default),
+                        digest,
+                        size,
+                        roboset,
+                        imgformat,
+                    )
+                except RenderBusyError:
+                    return busy_response(size)
+                response = CachingHttpResponse(
+                    cache_key,
+                    data,
+                    content_type="image/%s" % (imgformat or "png"),
+                    etag=etag,
+                )
+                response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
+                return response
+
+            if str(default) == "mm" or str(default) == "mp":
+                # If mm is explicitly given, we need to catch that
+                return static_default_response(
+                    request, cache_key, "mm", size, imgformat
+                )
+            return HttpResponseRedirect(default)
+
+        return static_default_response(request, cache_key, "nobody", size, imgformat)
+
 
 class GravatarProxyView(View):
     """
     Proxy request to Gravatar and return the image from there
-    """
 
-    # TODO: Do cache images!! Memcached?
+    This view is asynchronous, so (when running under ASGI) waiting for
+    Gravatar doesn't block a worker; the fetch itself runs in the shared
+    event loop, with its pooled connections
+    """
 
-    def get(
+    async def get(
         self, request, *args, **kwargs
     ):  # pylint: disable=too-many-branches,too-many-statements,too-many-locals,no-self-use,unused-argument,too-many-return-statements
         """
@@ -373,7 +526,6 @@ class GravatarProxyView(View):
             return HttpResponseRedirect(url)
 
         size = get_size(request)
-        gravatarimagedata = None
         default = None
 
         try:
@@ -382,72 +534,20 @@ class GravatarProxyView(View):
         except Exception:  # pylint: disable=bare-except
             pass
 
-        if str(default) != "wavatar":
-            # This part is special/hackish
-            # Check if the image returned by Gravatar is their default image, if so,
-            # redirect to our default instead.
-            gravatar_test_url = (
-                "https://secure.gravatar.com/avatar/"
-                + kwargs["digest"]
-                + "?s=%i&d=%i" % (50, 404)
-            )
-            if cache.get(gravatar_test_url) == "default":
-                # DEBUG only
-                # print("Cached Gravatar response: Default.")
-                return redir_default(default)
-            try:
-                urlopen(gravatar_test_url, timeout=URL_TIMEOUT)
-            except HTTPError as exc:
-                if exc.code == 404:
-                    cache.set(gravatar_test_url, "default", 60)
-                else:
-                    print("Gravatar test url fetch failed: %s" % exc)
-                return redir_default(default)
-
-        gravatar_url = (
-            "https://secure.gravatar.com/avatar/" + kwargs["digest"] + "?s=%i" % size
-        )
-        if default:
-            gravatar_url += "&d=%s" % default
-
         try:
-            if cache.get(gravatar_url) == "err":
-                print("Cached Gravatar fetch failed with URL error: %s" % gravatar_url)
-                return redir_default(default)
-
-            gravatarimagedata = urlopen(gravatar_url, timeout=URL_TIMEOUT)
-        except HTTPError as exc:
-            if exc.code != 404 and exc.code != 503:
-                print(
-                    "Gravatar fetch failed with an unexpected %s HTTP error: %s"
-                    % (exc.code, gravatar_url)
-                )
-            cache.set(gravatar_url, "err", 30)
-            return redir_default(default)
-        except URLError as exc:
-            print("Gravatar fetch failed with URL error: %s" % exc.reason)
-            cache.set(gravatar_url, "err", 30)
-            return redir_default(default)
-        except SSLError as exc:
-            print("Gravatar fetch failed with SSL error: %s" % exc.reason)
-            cache.set(gravatar_url, "err", 30)
-            return redir_default(default)
-        try:
-            data = BytesIO(gravatarimagedata.read())
-            img = Image.open(data)
-            data.seek(0)
-            response = HttpResponse(
-                data.read(), content_type="image/%s" % file_format(img.format)
-            )
-            response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
+            image = await gravatar_image_shared(kwargs["digest"], size, default)
+        except GravatarError:
+            # Gravatar may have an image, once it's back. Wavatars are only
+            # made by Gravatar, asking the proxy for them again would loop
+            response = redir_default(None if str(default) == "wavatar" else default)
+            response["Cache-Control"] = "no-store"
             return response
-
-        except ValueError as exc:
-            print("Value error: %s" % exc)
+        if image is None:
             return redir_default(default)
-
-        # We shouldn't reach this point... But make sure we do something
-        return redir_default(default)
+        (content, content_type) = image
+        response = HttpResponse(content, content_type=content_type)
+        response["Cache-Control"] = "max-age=%i" % CACHE_IMAGES_MAX_AGE
+        return response
 
 
 class StatsView(TemplateView, JsonResponse):
@@ -465,6 +565,8 @@ class StatsView(TemplateView, JsonResponse):
             "unconfirmed_mails": UnconfirmedEmail.objects.count(),  # pylint: disable=no-member
             "unconfirmed_openids": UnconfirmedOpenId.objects.count(),  # pylint: disable=no-member
             "avatars": Photo.objects.count(),  # pylint: disable=no-member
+            # Counters of this process' in-memory response cache
+            "response_cache": memory_cache.stats(),
         }
 
         return JsonResponse(retval)